@@ -1,5 +1,19 @@
 # pylint: disable=all
+import os
 import sys
+import time
+import random
+import shutil
+import tempfile
+import unittest
+import bisect
+import ctypes
+import mmap
+import struct
+import multiprocessing
+from array import array
+from StringIO import StringIO
+from fastinput import TokenReader
 
 
 class StationGraph(object):
@@ -25,6 +39,14 @@ class StationGraph(object):
 		##initialize it to our final stop (which goes nowhere)
 		self.station_graph ={int(self.final_stop):{}}
 
+		##filled in by contract_chains:
+		### contracted: {station: (chain head, cost from the head)}
+		### chains: {(head, tail): (chain cost, [stations in between])}
+		self.contracted = {}
+		self.chains = {}
+		##costs from station 0 found by the last shortest_path call
+		self.cost_table = None
+
 
 	def build_graph(self, key1, key2, value):
 		#the graph will be a nested dictionary, so we need 2 keys to get
@@ -78,6 +100,9 @@ class StationGraph(object):
 		while len(station_queue) > 0:
 
 			station = station_queue.pop() #grab the next node in the queue
+			if not D.has_key(station):
+				#nothing reaches this station, so it can't lead anywhere
+				continue
 
 			for next_st, next_cost in self.station_graph[station].iteritems():
 				#loops through the current station's neighbors, and calculates
@@ -90,23 +115,549 @@ class StationGraph(object):
 					#record the newly calculated cost as the lowest
 					D[next_st] = alt #set the cost to get to next_st
 
+		self.cost_table = D
 		return D[self.final_stop]
 
 
-if __name__ == '__main__':
+	def contract_chains(self):
+		"""
+		Optional preprocessing for sparse networks.  A station with exactly
+		one way in and one way out (after build_graph has dropped the
+		pricier parallel edges) is just a stop along a single train run, so
+		every such run is collapsed into one edge from the station before it
+		(the head) to the station after it (the tail), weighted with the sum
+		of its costs.  If the head already had an edge to the tail, the
+		cheaper of the two is kept, the same as build_graph would do.
+		Station 0 and the final stop are never contracted.  Contracted
+		stations are remembered in self.contracted so their cost can still
+		be asked for with station_cost, and the runs are kept in self.chains
+		so expand_route can put them back into a route.
+		Returns the number of stations removed.  Call it after the graph is
+		fully built.
+		"""
+		graph = self.station_graph
+		indegree = {}
+		for key1 in graph:
+			for key2 in graph[key1]:
+				indegree[key2] = indegree.get(key2, 0) + 1
+
+		def passthrough(station):
+			return (station != 0 and station != self.final_stop and
+				indegree.get(station) == 1 and len(graph.get(station, ())) == 1)
+
+		removed = 0
+		for head in graph.keys():
+			if not head in graph or passthrough(head):
+				continue
+			for first in graph[head].keys():
+				if not passthrough(first):
+					continue
+				#follow the run until it reaches a station that branches
+				cost = graph[head].pop(first)
+				between = []
+				station = first
+				while passthrough(station):
+					between.append(station)
+					self.contracted[station] = (head, cost)
+					(station, leg), = graph.pop(station).items()
+					cost += leg
+					removed += 1
+
+				current = graph[head].get(station)
+				if current is None or cost <= current:
+					graph[head][station] = cost
+				best = self.chains.get((head, station))
+				if best is None or cost < best[0]:
+					self.chains[(head, station)] = (cost, between)
+
+		self.cost_table = None
+		return removed
+
+
+	def station_cost(self, station):
+		"""
+		Cheapest cost from station 0 to any station, contracted or not, None
+		if it can't be reached.  Uses the costs of the last shortest_path.
+		"""
+		if self.cost_table is None:
+			self.shortest_path()
+		if station in self.contracted:
+			head, offset = self.contracted[station]
+			if not head in self.cost_table:
+				return None
+			return self.cost_table[head] + offset
+		return self.cost_table.get(station)
+
+
+	def expand_route(self, route):
+		"""
+		Take a route through the contracted graph (a list of stations) and
+		put back the stations of every contracted run it rides along.
+		"""
+		if not route:
+			return []
+		expanded = [route[0]]
+		for j in xrange(len(route) - 1):
+			chain = self.chains.get((route[j], route[j+1]))
+			if chain is not None and chain[0] == self.station_graph[route[j]][route[j+1]]:
+				expanded.extend(chain[1])
+			expanded.append(route[j+1])
+		return expanded
+
 
+class IncrementalStationGraph(StationGraph):
 	"""
-	The traingraph is initialized from standard input as follows:
+	A StationGraph that can be changed one train at a time without being
+	rebuilt.  Trains are added with add_train, so the graph knows which
+	trains provide each edge (build_graph adds a one leg train).  That is
+	what makes removing a train or raising one of its costs possible, since
+	the nested dict only keeps the cheapest cost of an edge.  Contraction is
+	not supported.
+	The cost table from station 0 is cached between calls.  A change to a
+	train can only affect stations after that train's first stop, so only
+	that suffix of the sorted stations is recomputed.  Each station pulls
+	its cost from its incoming edges (reverse_graph), which also picks up
+	edges that jump over the changed stop from further upstream.
+	"""
+
+	def __init__(self, numLines, finalStop):
+		super(IncrementalStationGraph, self).__init__(numLines, finalStop)
+
+		##train id -> (list of stops, list of costs)
+		self.trains = {}
+		##(station, station) -> {train id: cost}
+		self.edge_providers = {}
+		##same layout as station_graph, but keyed by destination first
+		### {station: {station it is reached from: cost}}
+		self.reverse_graph = {self.final_stop: {}}
+		##every known station, kept sorted
+		self.stations = [self.final_stop]
+
+		##cached costs from station 0, and the earliest stop changed since
+		self.cost_table = None
+		self._dirty_from = None
+		##number of single edges added through build_graph
+		self._edges_built = 0
+
+
+	def build_graph(self, key1, key2, value):
+		#a lone edge is a one leg train with an id of its own, so it is
+		#tracked like any other train and the cheapest provider still wins
+		self.add_train(('edge', self._edges_built), [key1, key2], [value])
+		self._edges_built += 1
+
+
+	def contract_chains(self):
+		#contracted runs would have to be undone on every change to a train
+		raise NotImplementedError("an IncrementalStationGraph can't be contracted")
+
+
+	def _mark_dirty(self, station):
+		if self._dirty_from is None or station < self._dirty_from:
+			self._dirty_from = station
+
+
+	def _add_station(self, station):
+		if not station in self.reverse_graph:
+			self.reverse_graph[station] = {}
+			bisect.insort(self.stations, station)
+
+
+	def _refresh_edge(self, key1, key2):
+		#put the cheapest remaining provider of an edge into both graphs
+		providers = self.edge_providers.get((key1, key2))
+		if providers:
+			value = min(providers.itervalues())
+			self.station_graph.setdefault(key1, {})[key2] = value
+			self.reverse_graph[key2][key1] = value
+		else:
+			self.edge_providers.pop((key1, key2), None)
+			self.station_graph.get(key1, {}).pop(key2, None)
+			self.reverse_graph[key2].pop(key1, None)
+
+
+	def add_train(self, train_id, stops, costs):
+		"""
+		Add a train line, costs[j] being the cost from stops[j] to
+		stops[j+1].  An existing train with the same id is replaced.
+		"""
+		if train_id in self.trains:
+			self.remove_train(train_id)
+		stops = [int(stop) for stop in stops]
+		costs = [int(cost) for cost in costs[:len(stops)-1]]
+		self.trains[train_id] = (stops, costs)
+
+		for stop in stops:
+			self._add_station(stop)
+		for j in xrange(len(costs)):
+			key1 = stops[j]
+			key2 = stops[j+1]
+			self.edge_providers.setdefault((key1, key2), {})[train_id] = costs[j]
+			self._refresh_edge(key1, key2)
+		if stops:
+			self._mark_dirty(stops[0])
+
+
+	def remove_train(self, train_id):
+		"""
+		Remove a train line.  Edges it was the only provider of disappear,
+		shared edges fall back to the cheapest remaining train.
+		"""
+		stops, costs = self.trains.pop(train_id)
+		for j in xrange(len(costs)):
+			key1 = stops[j]
+			key2 = stops[j+1]
+			self.edge_providers[(key1, key2)].pop(train_id, None)
+			self._refresh_edge(key1, key2)
+		if stops:
+			self._mark_dirty(stops[0])
+
+
+	def recost_train(self, train_id, costs):
+		"""
+		Change the costs of an existing train, keeping its stops.  Only the
+		suffix after the first leg whose cost changed needs recomputing.
+		"""
+		stops, old_costs = self.trains[train_id]
+		costs = [int(cost) for cost in costs[:len(stops)-1]]
+		for j in xrange(len(costs)):
+			if costs[j] != old_costs[j]:
+				key1 = stops[j]
+				key2 = stops[j+1]
+				self.edge_providers[(key1, key2)][train_id] = costs[j]
+				self._refresh_edge(key1, key2)
+				self._mark_dirty(key1)
+		self.trains[train_id] = (stops, costs)
+
+
+	def update_costs(self):
+		"""
+		Bring cost_table up to date.  The first call computes every station,
+		later calls only the stations downstream of the earliest change.
+		Returns the number of stations that were recomputed.
+		"""
+		if self.cost_table is None:
+			self.cost_table = {0:0}
+			first = bisect.bisect_right(self.stations, 0)
+		elif self._dirty_from is None:
+			return 0
+		else:
+			first = bisect.bisect_right(self.stations, self._dirty_from)
+		self._dirty_from = None
+
+		D = self.cost_table
+		for i in xrange(first, len(self.stations)):
+			station = self.stations[i]
+			best = None
+			for prev_st, prev_cost in self.reverse_graph[station].iteritems():
+				#take the cheapest way in from any station already costed
+				if prev_st in D:
+					alt = D[prev_st] + prev_cost
+					if best is None or alt < best:
+						best = alt
+			if best is None:
+				D.pop(station, None)
+			else:
+				D[station] = best
+		return len(self.stations) - first
+
+
+	def shortest_path(self):
+		"""
+		Same answer as StationGraph.shortest_path, from the cached table.
+		None if the final stop cannot be reached.
+		"""
+		self.update_costs()
+		return self.cost_table.get(self.final_stop)
+
+
+class CompactStationGraph(object):
+	"""
+	A compact alternative to StationGraph for very large networks.  Edges are
+	collected into flat integer arrays while the input is read, and the graph
+	is then compressed into CSR form (compressed sparse row): station ids are
+	mapped to dense indices 0..n-1 in sorted order, offsets[i] and
+	offsets[i+1] bound the outgoing edges of station i, and targets/costs hold
+	the destination index and travel cost of each of those edges.
+	Because trains only move forward, sorted order is also a topological
+	order, so shortest_path can sweep the indices from left to right without
+	hashing a single station.  Parallel edges collapse to the minimum cost
+	exactly as they do in StationGraph.build_graph.
+	"""
+
+	def __init__(self, numLines, finalStop):
+
+		self.final_stop = int(finalStop)
+		self.num_train_lines = int(numLines)
+
+		##raw edges as they come in, one slot per edge in each array
+		self._edge_src = array('l')
+		self._edge_dst = array('l')
+		self._edge_cost = array('l')
+
+		##CSR arrays, filled in by compress()
+		self.station_ids = None
+		self.offsets = None
+		self.targets = None
+		self.costs = None
+
+		##dense origin index -> cost list, filled in by precompute_origins
+		self.origin_tables = {}
+
+
+	def build_graph(self, key1, key2, value):
+		#just remember the edge, the real work is done once in compress()
+		self._edge_src.append(key1)
+		self._edge_dst.append(key2)
+		self._edge_cost.append(value)
+		self.station_ids = None
+		self.origin_tables = {}
+
+
+	def compress(self):
+		"""
+		Turn the raw edge arrays into CSR arrays.  A counting sort by source
+		station groups the edges in O(nodes + edges), then each group is
+		scanned once to keep only the cheapest edge to every neighbor.
+		"""
+		src = self._edge_src
+		dst = self._edge_dst
+		cost = self._edge_cost
+
+		stations = set(src)
+		stations.update(dst)
+		stations.add(self.final_stop)
+		station_ids = array('l', sorted(stations))
+		num_stations = len(station_ids)
+
+		#temporary raw id -> dense index lookup, dropped once we are done
+		index = dict((st, i) for i, st in enumerate(station_ids))
+		stations = None
+
+		#counting sort of the edges by their source index
+		counts = array('l', [0]) * (num_stations + 1)
+		src_index = array('l', [index[st] for st in src])
+		for i in src_index:
+			counts[i + 1] += 1
+		for i in xrange(num_stations):
+			counts[i + 1] += counts[i]
+		fill = array('l', counts)
+		by_src = array('l', [0]) * len(src)
+		for e in xrange(len(src)):
+			i = src_index[e]
+			by_src[fill[i]] = e
+			fill[i] += 1
+		fill = None
+		src_index = None
+
+		#collapse parallel edges, keeping the lowest cost
+		offsets = array('l', [0]) * (num_stations + 1)
+		targets = array('l')
+		costs = array('l')
+		for i in xrange(num_stations):
+			begin = counts[i]
+			end = counts[i + 1]
+			if end - begin == 1:
+				e = by_src[begin]
+				targets.append(index[dst[e]])
+				costs.append(cost[e])
+			elif end > begin:
+				cheapest = {}
+				for e in by_src[begin:end]:
+					j = index[dst[e]]
+					if not j in cheapest or cost[e] < cheapest[j]:
+						cheapest[j] = cost[e]
+				for j in sorted(cheapest):
+					targets.append(j)
+					costs.append(cheapest[j])
+			offsets[i + 1] = len(targets)
+
+		self.station_ids = station_ids
+		self.offsets = offsets
+		self.targets = targets
+		self.costs = costs
+
+
+	##snapshot layout: this header, then station_ids, offsets, targets
+	##and costs as native 64 bit integers, back to back
+	SNAPSHOT_MAGIC = 'DDSG'
+	SNAPSHOT_VERSION = 1
+	SNAPSHOT_HEADER = struct.Struct('=4sIqqqq')
+
+	def save(self, path):
+		"""
+		Write the CSR arrays and the station id mapping to a binary snapshot
+		that load() can map straight back into memory.
+		"""
+		if self.station_ids is None:
+			self.compress()
+		with open(path, 'wb') as snapshot:
+			snapshot.write(self.SNAPSHOT_HEADER.pack(
+				self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION,
+				self.final_stop, self.num_train_lines,
+				len(self.station_ids), len(self.targets)))
+			for values in (self.station_ids, self.offsets, self.targets, self.costs):
+				if isinstance(values, array) and values.itemsize == 8:
+					values.tofile(snapshot)
+				else:
+					snapshot.write(buffer((ctypes.c_int64 * len(values))(*values)))
+
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Open a snapshot written by save().  The file is memory mapped and the
+		CSR arrays are ctypes views into the mapping, so nothing is parsed or
+		copied: startup costs a few page faults, and several processes
+		loading the same file share its pages (the mapping is copy on write,
+		which ctypes needs, but nothing ever writes to it).
+		"""
+		with open(path, 'rb') as snapshot:
+			mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_COPY)
+		header = cls.SNAPSHOT_HEADER
+		if len(mapped) < header.size:
+			raise ValueError("%s is not a station graph snapshot" % path)
+		magic, version, final_stop, num_lines, num_stations, num_edges = \
+			header.unpack_from(mapped)
+		if magic != cls.SNAPSHOT_MAGIC:
+			raise ValueError("%s is not a station graph snapshot" % path)
+		if version != cls.SNAPSHOT_VERSION:
+			raise ValueError("unsupported snapshot version %d in %s" % (version, path))
+		if len(mapped) != header.size + 8 * (2 * num_stations + 1 + 2 * num_edges):
+			raise ValueError("%s is truncated" % path)
+
+		graph = cls(num_lines, final_stop)
+		offset = header.size
+		views = []
+		for count in (num_stations, num_stations + 1, num_edges, num_edges):
+			views.append((ctypes.c_int64 * count).from_buffer(mapped, offset))
+			offset += 8 * count
+		graph.station_ids, graph.offsets, graph.targets, graph.costs = views
+		#the views keep a reference to the mapping, this just makes it explicit
+		graph._snapshot = mapped
+		return graph
+
+
+	def station_index(self, station):
+		"""
+		dense index of a raw station id, or None if the station is unknown
+		"""
+		if self.station_ids is None:
+			self.compress()
+		i = bisect.bisect_left(self.station_ids, station)
+		if i < len(self.station_ids) and self.station_ids[i] == station:
+			return i
+		return None
+
+
+	def print_station_graph(self):
+		if self.station_ids is None:
+			self.compress()
+		for i in xrange(len(self.station_ids)):
+			print str(self.station_ids[i])+"->",
+			for e in xrange(self.offsets[i], self.offsets[i + 1]):
+				print str(self.station_ids[self.targets[e]])+':'+str(self.costs[e])+",",
+			print ""
+
+
+	def sweep(self, origin, last=None):
+		"""
+		One linear pass over the DAG from the dense index origin.  Returns a
+		list with the cheapest cost from origin to every station index, None
+		where a station cannot be reached.  Stations before origin can never
+		be reached, and the pass stops early after index last if given.
+		"""
+		if self.station_ids is None:
+			self.compress()
+		offsets = self.offsets
+		targets = self.targets
+		costs = self.costs
+		if last is None:
+			last = len(self.station_ids) - 1
+
+		D = [None] * len(self.station_ids)
+		D[origin] = 0
+		for station in xrange(origin, last + 1):
+			station_cost = D[station]
+			if station_cost is None:
+				continue
+			for e in xrange(offsets[station], offsets[station + 1]):
+				next_st = targets[e]
+				alt = station_cost + costs[e]
+				if D[next_st] is None or alt < D[next_st]:
+					D[next_st] = alt
+		return D
+
+
+	def shortest_path(self, origin=0):
+		"""
+		Same answer as StationGraph.shortest_path, but the sweep walks the
+		dense station indices in order and keeps its costs in a flat list
+		instead of a dict.  None marks a station that has not been reached.
+		"""
+		start = self.station_index(origin)
+		if start is None:
+			#no train stops at origin, so nothing can be reached from it
+			return None
+		end = self.station_index(self.final_stop)
+		return self.sweep(start, end)[end]
+
+
+	def precompute_origins(self, origins):
+		"""
+		Keep the full all-destinations cost table for each of the given
+		(raw) origin stations, so queries from hot origins are answered by a
+		lookup instead of a sweep.  Costs one list of n entries per origin.
+		"""
+		for origin in origins:
+			start = self.station_index(origin)
+			if start is not None:
+				self.origin_tables[start] = self.sweep(start)
+
+
+	def batch_query(self, queries):
+		"""
+		Answer a batch of (origin, destination) pairs of raw station ids and
+		return their costs in the same order, None for pairs that have no
+		route.  Queries are grouped by origin, so every distinct origin
+		costs one sweep, and that sweep stops at the furthest destination
+		asked for.  Origins with a precomputed table need no sweep at all.
+		"""
+		results = [None] * len(queries)
+		by_origin = {}
+		for q, (origin, destination) in enumerate(queries):
+			start = self.station_index(origin)
+			end = self.station_index(destination)
+			if start is None or end is None or end < start:
+				continue
+			by_origin.setdefault(start, []).append((q, end))
+
+		for start, wanted in by_origin.iteritems():
+			D = self.origin_tables.get(start)
+			if D is None:
+				D = self.sweep(start, max(end for q, end in wanted))
+			for q, end in wanted:
+				results[q] = D[end]
+		return results
+
+
+def read_station_graph(reader, compact=False):
+	"""
+	The traingraph is initialized from a TokenReader as follows:
 	first line is two integers separated by a space.
 	first integer is represented by "K" in description
 	but will be numLines here.
 	The second integer is the position of the destination D which
 	will be called finalStop here
+	With compact=True the graph is a CompactStationGraph.
 	"""
 
 	##instantiate our object to set up its internals
-	numLines, finalStop = sys.stdin.readline().strip().split()
-	tripPlanner = StationGraph(numLines, finalStop)
+	numLines, finalStop = reader.line_ints()
+	if compact:
+		tripPlanner = CompactStationGraph(numLines, finalStop)
+	else:
+		tripPlanner = StationGraph(numLines, finalStop)
 
 	"""
 	The next few lines will be read in groups of 3,
@@ -115,20 +666,420 @@ if __name__ == '__main__':
 	3rd line is list of costs per stop
 	"""
 	for i in xrange (0,tripPlanner.num_train_lines):
-		numstops = sys.stdin.readline().strip()
-		stopline = sys.stdin.readline().strip().split()
-		costline = sys.stdin.readline().strip().split()
+		numstops = reader.line_ints()[0]
+		stopline = reader.line_ints()
+		costline = reader.line_ints()
         ##pass in each station, what it points to, and its travel cost
-		for j in xrange(0, int(numstops)-1):
+		for j in xrange(0, numstops-1):
 			#build the graph, one node at a time
 			tripPlanner.build_graph(
-				int(stopline[j]),
-				int(stopline[j+1]),
-				int(costline[j])
+				stopline[j],
+				stopline[j+1],
+				costline[j]
 			)
+	return tripPlanner
+
+
+def solve_instance(source):
+	"""
+	Build and solve one trip planning instance.  source is either the path
+	of an instance file or a tuple holding the instance text.  Returns the
+	lowest cost (None if the final stop can't be reached), the number of
+	seconds it took and an error message, None unless the instance could
+	not be read or solved.  This is what every batch worker runs, so a bad
+	instance is reported instead of taking the whole batch down.
+	"""
+	start = time.time()
+	try:
+		if isinstance(source, tuple):
+			reader = TokenReader(StringIO(source[0]))
+		else:
+			reader = TokenReader(source)
+		tripPlanner = read_station_graph(reader)
+		try:
+			answer = tripPlanner.shortest_path()
+		except KeyError:
+			answer = None
+	except Exception as error:
+		return None, time.time() - start, "%s: %s" % (type(error).__name__, error)
+	return answer, time.time() - start, None
+
+
+def split_instances(reader):
+	"""
+	Cut a stream of back to back instances into one text per instance.
+	Each instance is a header line and three lines for every train.
+	Raises ValueError if the stream ends in the middle of an instance.
+	"""
+	count = 0
+	while True:
+		header = reader.line()
+		if header is None:
+			return
+		if not header:
+			continue
+		numLines = int(header.split()[0])
+		lines = [header]
+		for i in xrange(3 * numLines):
+			line = reader.line()
+			if line is None:
+				raise ValueError("instance %d is truncated: input ended after %d of its %d lines" % (
+					count, len(lines), 3 * numLines + 1))
+			lines.append(line)
+		yield ("\n".join(lines) + "\n",)
+		count += 1
 
+
+def run_batch(sources, workers=None):
+	"""
+	Solve many independent instances in a process pool spread over all
+	cores (or the given number of workers), so interpreter startup is paid
+	once per worker instead of once per instance.  Results are printed in
+	input order, and the time of each instance plus the total go to stderr.
+	An instance that fails prints "error" in its place and its reason to
+	stderr.  If sources itself fails (a truncated stream) the instances
+	before it are still solved.  Returns the number of failures.
 	"""
-	Now that the graph is built, call shortest_path to determine
-	the lowest cost from beginning to end.
+	start = time.time()
+	source_errors = []
+
+	def guarded():
+		#the pool reads sources in a thread of its own, where an exception
+		#would be lost, so keep it and report it once the results are in
+		try:
+			for source in sources:
+				yield source
+		except Exception as error:
+			source_errors.append("%s: %s" % (type(error).__name__, error))
+
+	pool = multiprocessing.Pool(workers)
+	failed = 0
+	try:
+		results = pool.imap(solve_instance, guarded(), 16)
+		count = 0
+		for answer, elapsed, error in results:
+			if error is None:
+				print answer
+				sys.stderr.write("instance %d: %.4fs\n" % (count, elapsed))
+			else:
+				print "error"
+				sys.stderr.write("instance %d failed: %s\n" % (count, error))
+				failed += 1
+			count += 1
+	finally:
+		pool.close()
+		pool.join()
+	for error in source_errors:
+		sys.stderr.write("input failed: %s\n" % error)
+		failed += 1
+	sys.stderr.write("%d instances in %.3fs, %d failed\n" % (count, time.time() - start, failed))
+	return failed
+
+
+class UnitTests(unittest.TestCase):
 	"""
-	print tripPlanner.shortest_path()
+	StationGraph, CompactStationGraph (queries and snapshots included) and
+	contracted graphs against each other and a brute force search on small
+	random networks, IncrementalStationGraph against a from scratch search
+	over the trains it currently holds after every add, remove and recost
+	(build_graph included), and batch mode with broken input.
+	"""
+
+	@staticmethod
+	def brute_force(trains, final_stop, origin=0):
+		#cheapest cost of every station, in increasing station order
+		legs = [(stops[j], stops[j+1], costs[j])
+			for stops, costs in trains.itervalues() for j in xrange(len(costs))]
+		best = {origin: 0}
+		for station in sorted(set(leg[1] for leg in legs)):
+			ways = [best[start] + cost for start, end, cost in legs
+				if end == station and start in best]
+			if ways:
+				best[station] = min(ways)
+		return best.get(final_stop)
+
+	@staticmethod
+	def random_trains(rng, final_stop):
+		"""
+		{train id: (stops, costs)}, sometimes without a train from station 0
+		"""
+		trains = {}
+		for k in xrange(rng.randint(1, 6)):
+			stops = sorted(rng.sample(xrange(1, final_stop), rng.randint(1, min(6, final_stop - 1))))
+			if rng.random() < 0.7:
+				stops.insert(0, 0)
+			if rng.random() < 0.6:
+				stops.append(final_stop)
+			if len(stops) < 2:
+				continue
+			trains[k] = (stops, [rng.randint(0, 9) for j in xrange(len(stops) - 1)])
+		return trains
+
+	@staticmethod
+	def build(graph, trains):
+		for stops, costs in trains.itervalues():
+			for j in xrange(len(costs)):
+				graph.build_graph(stops[j], stops[j+1], costs[j])
+		return graph
+
+	@staticmethod
+	def station_graph_cost(graph):
+		#StationGraph raises KeyError when the final stop is out of reach
+		try:
+			return graph.shortest_path()
+		except KeyError:
+			return None
+
+	def test_CompactShortestPath(self):
+		rng = random.Random(1)
+		for n in xrange(500):
+			final_stop = rng.randint(2, 25)
+			trains = self.random_trains(rng, final_stop)
+			expected = self.station_graph_cost(self.build(StationGraph(0, final_stop), trains))
+			self.assertEqual(expected, self.brute_force(trains, final_stop))
+			self.assertEqual(self.build(CompactStationGraph(0, final_stop), trains).shortest_path(), expected)
+
+		#no train stops at station 0 at all
+		graph = CompactStationGraph(1, 10)
+		graph.build_graph(3, 10, 2)
+		self.assertEqual(graph.shortest_path(), None)
+		self.assertEqual(graph.shortest_path(3), 2)
+
+	def test_BatchQuery(self):
+		rng = random.Random(5)
+		for n in xrange(300):
+			final_stop = rng.randint(2, 25)
+			trains = self.random_trains(rng, final_stop)
+			graph = self.build(CompactStationGraph(0, final_stop), trains)
+			reference = self.build(StationGraph(0, final_stop), trains)
+			#fills in reference.cost_table even if the final stop is out of reach
+			self.station_graph_cost(reference)
+			#stations no train stops at have no route, station_cost works
+			#from station 0 and brute_force from anywhere
+			known = set(stop for stops, costs in trains.itervalues() for stop in stops)
+			known.add(final_stop)
+			queries = [(rng.randint(-1, final_stop + 1), rng.randint(-1, final_stop + 1))
+				for q in xrange(30)]
+			queries.extend((0, station) for station in xrange(final_stop + 1))
+			expected = []
+			for origin, destination in queries:
+				if not origin in known or not destination in known:
+					expected.append(None)
+				elif origin == 0:
+					expected.append(reference.station_cost(destination))
+				else:
+					expected.append(self.brute_force(trains, destination, origin))
+			self.assertEqual(graph.batch_query(queries), expected)
+			graph.precompute_origins(rng.sample(xrange(-1, final_stop + 2), 4))
+			self.assertEqual(graph.batch_query(queries), expected)
+
+	def test_ContractChains(self):
+		rng = random.Random(8)
+		removed = 0
+		for n in xrange(500):
+			final_stop = rng.randint(2, 25)
+			trains = self.random_trains(rng, final_stop)
+			reference = self.build(StationGraph(0, final_stop), trains)
+			graph = self.build(StationGraph(0, final_stop), trains)
+			count = graph.contract_chains()
+			self.assertEqual(count, len(graph.contracted))
+			removed += count
+			self.assertEqual(self.station_graph_cost(graph), self.station_graph_cost(reference))
+			for station in xrange(-1, final_stop + 2):
+				self.assertEqual(graph.station_cost(station), reference.station_cost(station))
+
+			#every edge left expands into a run of the original graph
+			#that costs the same
+			for head in graph.station_graph:
+				for tail, cost in graph.station_graph[head].iteritems():
+					route = graph.expand_route([head, tail])
+					self.assertEqual(route[0], head)
+					self.assertEqual(route[-1], tail)
+					self.assertEqual(cost, sum(reference.station_graph[route[j]][route[j+1]]
+						for j in xrange(len(route) - 1)))
+		self.assertTrue(removed > 0)
+
+	def test_SnapshotRoundTrip(self):
+		rng = random.Random(9)
+		folder = tempfile.mkdtemp()
+		try:
+			path = os.path.join(folder, 'graph.snapshot')
+			for n in xrange(100):
+				final_stop = rng.randint(2, 25)
+				trains = self.random_trains(rng, final_stop)
+				graph = self.build(CompactStationGraph(len(trains), final_stop), trains)
+				graph.save(path)
+				loaded = CompactStationGraph.load(path)
+				self.assertEqual((loaded.final_stop, loaded.num_train_lines),
+					(final_stop, len(trains)))
+				for name in ('station_ids', 'offsets', 'targets', 'costs'):
+					self.assertEqual(list(getattr(loaded, name)), list(getattr(graph, name)))
+				queries = [(rng.randint(0, final_stop), rng.randint(0, final_stop))
+					for q in xrange(20)]
+				self.assertEqual(loaded.shortest_path(), graph.shortest_path())
+				self.assertEqual(loaded.batch_query(queries), graph.batch_query(queries))
+
+			#a snapshot of a loaded graph is the same file again
+			with open(path, 'rb') as snapshot:
+				data = snapshot.read()
+			loaded.save(path + '2')
+			with open(path + '2', 'rb') as snapshot:
+				self.assertEqual(snapshot.read(), data)
+
+			with open(path, 'wb') as snapshot:
+				snapshot.write(data[:-8])
+			self.assertRaises(ValueError, CompactStationGraph.load, path)
+			with open(path, 'wb') as snapshot:
+				snapshot.write('XXXX' + data[4:])
+			self.assertRaises(ValueError, CompactStationGraph.load, path)
+		finally:
+			shutil.rmtree(folder)
+
+	def test_IncrementalUpdates(self):
+		rng = random.Random(3)
+		for n in xrange(30):
+			final_stop = 20
+			graph = IncrementalStationGraph(0, final_stop)
+			trains = {}
+			next_id = 0
+			for step in xrange(60):
+				action = rng.random()
+				if action < 0.5 or not trains:
+					stops = sorted(rng.sample(xrange(1, final_stop), rng.randint(1, 5)))
+					if rng.random() < 0.7:
+						stops.insert(0, 0)
+					if rng.random() < 0.5:
+						stops.append(final_stop)
+					costs = [rng.randint(0, 9) for j in xrange(len(stops) - 1)]
+					trains[next_id] = (stops, costs)
+					graph.add_train(next_id, stops, costs)
+					next_id += 1
+				elif action < 0.75:
+					train_id = rng.choice(sorted(trains))
+					del trains[train_id]
+					graph.remove_train(train_id)
+				else:
+					train_id = rng.choice(sorted(trains))
+					stops, costs = trains[train_id]
+					costs = [rng.randint(0, 9) for cost in costs]
+					trains[train_id] = (stops, costs)
+					graph.recost_train(train_id, costs)
+				self.assertEqual(graph.shortest_path(), self.brute_force(trains, final_stop))
+
+	def test_IncrementalBuildGraph(self):
+		#the methods inherited from StationGraph must not bypass the trains
+		graph = IncrementalStationGraph(0, 10)
+		graph.add_train('a', [0, 5, 10], [3, 3])
+		self.assertEqual(graph.shortest_path(), 6)
+		graph.build_graph(0, 10, 1)
+		self.assertEqual(graph.shortest_path(), 1)
+		graph.build_graph(0, 10, 4)
+		self.assertEqual(graph.shortest_path(), 1)
+		graph.recost_train('a', [0, 0])
+		self.assertEqual(graph.shortest_path(), 0)
+		graph.remove_train('a')
+		self.assertEqual(graph.shortest_path(), 1)
+		self.assertRaises(NotImplementedError, graph.contract_chains)
+
+
+	EXAMPLE = "2 10\n5\n0 2 4 6 10\n3 4 5 1\n4\n0 4 9 10\n5 10 1\n"
+
+	def test_SplitInstancesTruncated(self):
+		reader = TokenReader(StringIO(self.EXAMPLE + self.EXAMPLE + "2 10\n2\n0 10\n"))
+		instances = split_instances(reader)
+		self.assertEqual(next(instances), (self.EXAMPLE,))
+		self.assertEqual(next(instances), (self.EXAMPLE,))
+		self.assertRaises(ValueError, next, instances)
+
+	def run_quietly(self, sources):
+		#run_batch prints its answers, keep them for the test instead
+		stdout, stderr = sys.stdout, sys.stderr
+		sys.stdout, sys.stderr = StringIO(), StringIO()
+		try:
+			failed = run_batch(sources, 1)
+			return failed, sys.stdout.getvalue().split()
+		finally:
+			sys.stdout, sys.stderr = stdout, stderr
+
+	def test_BatchFailures(self):
+		self.assertEqual(solve_instance((self.EXAMPLE,))[2], None)
+		self.assertNotEqual(solve_instance(("1 5\n2\n0 5\n",))[2], None)
+
+		#a malformed instance fails alone, the others are still answered
+		sources = [(self.EXAMPLE,), ("1 5\n2\n0 5\n",), (self.EXAMPLE,)]
+		self.assertEqual(self.run_quietly(sources), (1, ["11", "error", "11"]))
+
+		#a truncated stream keeps the answers read before it, but fails
+		reader = TokenReader(StringIO(self.EXAMPLE + self.EXAMPLE + "2 10\n2\n0 10\n"))
+		self.assertEqual(self.run_quietly(split_instances(reader)), (1, ["11", "11"]))
+
+
+if __name__ == '__main__':
+
+	"""
+	Command line options:
+		--compact      store the graph as flat CSR arrays instead of dicts
+		--contract     collapse single train runs before solving
+		--queries      answer a batch of origin/destination queries
+		--save FILE    write a binary snapshot of the (compact) graph
+		--load FILE    start from a snapshot instead of reading trains,
+		               stdin then only holds the queries, if any
+		--batch [FILE ...]
+		               solve many instances in a process pool, one per
+		               file, or back to back on stdin if no files are given
+		--workers N    number of batch worker processes (default: all cores)
+	"""
+	args = sys.argv[1:]
+	reader = TokenReader(sys.stdin)
+	if '--batch' in args:
+		workers = None
+		if '--workers' in args:
+			workers = int(args[args.index('--workers') + 1])
+		#instance files are everything after --batch up to the next option
+		files = []
+		for arg in args[args.index('--batch') + 1:]:
+			if arg.startswith('--'):
+				break
+			files.append(arg)
+		if files:
+			failed = run_batch(files, workers)
+		else:
+			failed = run_batch(split_instances(reader), workers)
+		sys.exit(1 if failed else 0)
+
+	if '--load' in args:
+		tripPlanner = CompactStationGraph.load(args[args.index('--load') + 1])
+	else:
+		compact = '--compact' in args or '--queries' in args or '--save' in args
+		tripPlanner = read_station_graph(reader, compact)
+	if '--save' in args:
+		tripPlanner.save(args[args.index('--save') + 1])
+
+	"""
+	With --queries the trains are followed by a line with the number of
+	queries Q, then Q lines of "origin destination".  One cost is printed
+	per query (None when there is no route) and the throughput goes to
+	stderr.  Otherwise, call shortest_path to determine the lowest cost
+	from beginning to end.
+	"""
+	if '--queries' in args:
+		queries = []
+		for i in xrange(reader.line_ints()[0]):
+			origin, destination = reader.line_ints()
+			queries.append((origin, destination))
+
+		start = time.time()
+		if tripPlanner.station_ids is None:
+			tripPlanner.compress()
+		results = tripPlanner.batch_query(queries)
+		elapsed = time.time() - start
+
+		for result in results:
+			print result
+		sys.stderr.write("%d queries in %.3fs (%.0f queries/sec)\n" % (
+			len(queries), elapsed, len(queries) / max(elapsed, 1e-9)))
+	else:
+		if '--contract' in args and isinstance(tripPlanner, StationGraph):
+			#collapse single train runs before solving
+			tripPlanner.contract_chains()
+		print tripPlanner.shortest_path()
@@ -1,5 +1,12 @@
 # pylint: disable=all
 import sys
+import random
+import operator
+import unittest
+from array import array
+from itertools import repeat
+import DevDraftFinals1
+from fastinput import TokenReader
 
 
 class StationNode(object):
@@ -31,6 +38,8 @@ class Train(object):
 		self.totalstops=int(numstops)
 		self.stops_dict={}
 		self.solo_cost = solocost
+		#stops in riding order, stops_dict alone loses the last stop
+		self.stops = [int(stop) for stop in stoplist]
 		if len(stoplist) <= len(costlist):
 				print "bad input, can't have more costs than stops"
 		else:
@@ -40,7 +49,29 @@ class Train(object):
 	def printMyDict(self):
 		print self.stops_dict
 
-class StationGraph(object):
+class Itinerary(object):
+	"""
+	An itinerary is the result of a traced shortest path: the total cost,
+	every stop along the way in order, and the train ridden on each leg
+	(trains[j] takes the passenger from stops[j] to stops[j+1]).  switches
+	lists the stops where the train changes from one leg to the next.
+	"""
+	def __init__(self, cost, stops, trains):
+		self.cost = cost
+		self.stops = stops
+		self.trains = trains
+		self.switches = [stops[j] for j in xrange(1, len(trains))
+			if trains[j] != trains[j-1]]
+
+	def __str__(self):
+		lines = [str(self.cost)]
+		for j in xrange(len(self.trains)):
+			lines.append("%d -> %d on train %s" % (
+				self.stops[j], self.stops[j+1], self.trains[j]))
+		lines.append("switches at: " + " ".join(str(st) for st in self.switches))
+		return "\n".join(lines)
+
+class StationGraph(DevDraftFinals1.StationGraph):
 	"""
 	A stationgraph allows a graph data structure to be built by
 	passing in information one station at a time.  From the graph's
@@ -55,19 +86,18 @@ class StationGraph(object):
 
 	def __init__(self, numLines, finalStop, switchLimit):
 
-		self.final_stop = int(finalStop)
-		self.num_train_lines = int(numLines)
+		##sets up station_graph and the chain contraction bookkeeping
+		super(StationGraph, self).__init__(numLines, finalStop)
 		self.switch_limit = int(switchLimit)
 		self.num_switches = 0
 
 		self.switching_points = []
-		##station_graph is a nested dict organized as follows:
-		### {station: {station: cost, station: cost, station: cost} }
-		##initialize it to our final stop (which goes nowhere)
-		self.station_graph ={int(self.final_stop):{}}
+		##(station, station) -> the train that provides the cheapest edge,
+		##only filled in when build_graph is told which train it is
+		self.edge_trains = {}
 
 
-	def build_graph(self, key1, key2, value):
+	def build_graph(self, key1, key2, value, train=None):
 		#the graph will be a nested dictionary, so we need 2 keys to get
 		#to a value.  The value will be the cost of traveling from
 		#key1 to key2
@@ -79,7 +109,12 @@ class StationGraph(object):
 			current = self.station_graph[key1][key2]
 			if value < current:
 				self.station_graph[key1][key2]=value
+			else:
+				#the train already on record stays the cheapest
+				train = None
 			self.switching_points.append(key1)
+		if train is not None:
+			self.edge_trains[(key1, key2)] = train
 
 
 	def print_station_graph(self):
@@ -90,7 +125,7 @@ class StationGraph(object):
 			print ""
 
 
-	def shortest_path(self):
+	def shortest_path(self, itinerary=False):
 		"""
 		Using Djikstra's shortest path algorithm, determine optimal costs
 		from the start station to each subsequent station, then return the
@@ -102,11 +137,14 @@ class StationGraph(object):
 		the graph is treated as directed and acyclic, which is great because
 		it allows the shortest path calculation to be done in linear time
 		O(nodes + edges)
+		With itinerary=True an Itinerary is returned instead of the cost.
+		The predecessors are kept in a flat array indexed by position in
+		the sorted station list, so tracing the route back is linear in its
+		length, which matters for routes with tens of thousands of legs.
 		"""
 		#dict that will hold the cost of traveling to each station
 		#add the initial cost of the starting station, which is 0
 		D = {0:0}
-		P = {} #a list of nodes visited, in case we want to trace the path
 
 		#add all of our dict keys (stations) to our queue
 		station_queue = self.station_graph.keys()
@@ -120,10 +158,19 @@ class StationGraph(object):
 		#some cpu time.
 		station_queue.sort(reverse=True)
 
+		#P[i] is the position of the station we came from to reach the
+		#station at position i of the sorted list, -1 if there is none
+		if itinerary:
+			stations = station_queue[::-1]
+			position = dict((st, i) for i, st in enumerate(stations))
+			P = array('l', [-1]) * len(stations)
+
 		while len(station_queue) > 0:
 
 			station = station_queue.pop() #grab the next node in the queue
-
+			if not D.has_key(station):
+				#nothing reaches this station, so it can't lead anywhere
+				continue
 
 			for next_st, next_cost in self.station_graph[station].iteritems():
 				#loops through the current station's neighbors, and calculates
@@ -135,32 +182,355 @@ class StationGraph(object):
 					#cost is lower than the currently recorded one, then
 					#record the newly calculated cost as the lowest
 					D[next_st] = alt #set the cost to get to next_st
-					P[next_st] = station
-
-		S = list()
-
-		while P.has_key(station):
-			S.insert(0,P[station])
-#			print "station is: ",
-#			print station
-#			print "my switching points: ",
-#			print self.switching_points
-#			if station in self.switching_points:
-#				self.num_switches = self.num_switches + 1
-			station = P[station]
-#		print "my switching points: ",
-#		print self.switching_points
-#		print "number of switches taken: ",
-#		print self.num_switches
-		return D[self.final_stop]
-
-	def shortest_x_paths(self, k=2):
+					if itinerary and next_st in position:
+						P[position[next_st]] = position[station]
+
+		self.cost_table = D
+		if not itinerary:
+			return D[self.final_stop]
+
+		#walk back from the final stop, then flip the route around and put
+		#back any stations that contract_chains took out
+		route = []
+		i = position[self.final_stop]
+		while i != -1:
+			route.append(stations[i])
+			i = P[i]
+		route.reverse()
+		route = self.expand_route(route)
+		trains = [self.edge_trains.get((route[j], route[j+1]))
+			for j in xrange(len(route) - 1)]
+		return Itinerary(D[self.final_stop], route, trains)
+
+
+
+def _vector_min(a, b):
+	"""
+	elementwise min of two cost vectors, the shorter one is treated as if
+	it were padded out with infinite costs
+	"""
+	if len(a) < len(b):
+		a, b = b, a
+	merged = map(min, a[:len(b)], b)
+	merged.extend(a[len(b):])
+	return merged
+
+
+def _merge_labels(a, b):
+	"""
+	Merge two lists of (switches, cost) labels, each sorted by switches with
+	strictly falling costs, into one list of the same shape.  A label is
+	dropped when another label reaches the stop as cheaply with no more
+	switches, so only the Pareto frontier survives.
+	"""
+	merged = []
+	best = float('inf')
+	i = 0
+	j = 0
+	while i < len(a) or j < len(b):
+		if j >= len(b) or (i < len(a) and a[i][0] <= b[j][0]):
+			label = a[i]
+			i += 1
+		else:
+			label = b[j]
+			j += 1
+		if label[1] < best:
+			if merged and merged[-1][0] == label[0]:
+				merged[-1] = label
+			else:
+				merged.append(label)
+			best = label[1]
+	return merged
+
+
+class TrainRouter(object):
+	"""
+	A TrainRouter answers the switch limited version of the problem.  Unlike
+	StationGraph it keeps every train separate, since riding the same edge
+	on a different train may cost an extra switch.
+	The solution is a dynamic program over (station, train, switches used).
+	Stations are visited in increasing order, which is a topological order
+	because trains only move forward.  For each train we carry a vector of
+	the cheapest cost to reach its current stop for every switch count
+	0..switchLimit.  At a station, prefix and suffix minima over the
+	arriving trains give the cheapest arrival on any *other* train for each
+	switch count, which is what a switch onto a departing train costs.  The
+	whole run is O(stops * switchLimit) instead of enumerating k shortest
+	paths.  Vectors are cut off after the highest switch count that has
+	actually been reached, so sparse networks pay far less than the bound.
+	"""
+
+	def __init__(self, finalStop, switchLimit, trains=None):
+		self.final_stop = int(finalStop)
+		self.switch_limit = int(switchLimit)
+		self.trains = []
+		for train in trains or []:
+			self.add_train(train)
+
+
+	def add_train(self, train):
+		self.trains.append(train)
+
+
+	def station_events(self):
+		"""
+		list of (station, train index, stop position) for every stop of
+		every train, sorted by station
+		"""
+		events = []
+		for t, train in enumerate(self.trains):
+			for pos, stop in enumerate(train.stops):
+				events.append((stop, t, pos))
+		events.sort()
+		return events
+
+
+	def cheapest_path(self, switchLimit=None):
+		"""
+		Return the lowest cost from station 0 to final_stop using at most
+		switchLimit train switches (self.switch_limit by default), or None if
+		the final stop cannot be reached within the limit.
+		"""
+		if switchLimit is None:
+			switchLimit = self.switch_limit
+		INF = float('inf')
+		events = self.station_events()
+
+		#there can never be more switches than stops to switch at
+		width = max(0, min(int(switchLimit), len(events))) + 1
+
+		#arrive[t][k] is the cost of reaching train t's current stop on
+		#train t after k switches.  None until the train has been boarded.
+		#Switch counts past the end of the list have not been reached.
+		arrive = [None] * len(self.trains)
+		no_arrival = []
+
+		i = 0
+		while i < len(events):
+			station = events[i][0]
+			j = i
+			while j < len(events) and events[j][0] == station:
+				j += 1
+
+			#arrival vectors of every train that has been ridden to here
+			owners = []
+			vectors = []
+			for e in xrange(i, j):
+				t = events[e][1]
+				if arrive[t] is not None:
+					owners.append(t)
+					vectors.append(arrive[t])
+
+			if station == self.final_stop:
+				#nothing past the final stop can lead back to it
+				best = min([min(costs) for costs in vectors] or [INF])
+				if best == INF:
+					return None
+				return best
+
+			#before[x] and after[x] are the elementwise minimum of
+			#vectors[:x] and vectors[x:], so the best arrival on any train
+			#other than vectors[x] is min(before[x], after[x+1])
+			m = len(vectors)
+			before = [no_arrival]
+			for costs in vectors:
+				before.append(_vector_min(before[-1], costs))
+			after = [no_arrival] * (m + 1)
+			for x in xrange(m - 1, -1, -1):
+				after[x] = _vector_min(after[x + 1], vectors[x])
+			slot = dict(zip(owners, xrange(m)))
+
+			for e in xrange(i, j):
+				t = events[e][1]
+				pos = events[e][2]
+				train = self.trains[t]
+				if pos + 1 >= len(train.stops):
+					#end of the line
+					arrive[t] = None
+					continue
+
+				x = slot.get(t)
+				if x is None:
+					#first stop of this train, it can only be boarded
+					stay = no_arrival
+					other = before[m]
+				elif m == 1:
+					#nobody else is here, so there is nothing to switch from
+					stay = vectors[x]
+					other = None
+				else:
+					stay = vectors[x]
+					other = _vector_min(before[x], after[x + 1])
+
+				if other:
+					#switching from another train costs one more switch
+					board = _vector_min(stay, [INF] + other[:width - 1])
+				else:
+					board = stay
+				if station == 0:
+					#passengers start here and may board any train for free
+					board = [0] + board[1:]
+				if not board:
+					#not reachable yet
+					arrive[t] = None
+					continue
+
+				leg = train.stops_dict[station]
+				arrive[t] = map(operator.add, board, repeat(leg, len(board)))
+
+			i = j
+
+		return None
+
+
+	def cost_frontier(self, switchLimit=None):
+		"""
+		Return the Pareto frontier of the trip from station 0 to final_stop
+		as a list of (switches, min cost) pairs, sorted by switches.  Each
+		pair is cheaper than every pair before it, so the list shows exactly
+		what every extra allowed switch saves.  switchLimit optionally caps
+		the number of switches considered.
+		This is the same sweep as cheapest_path, but each train carries only
+		its non-dominated (switches, cost) labels instead of a full vector
+		per switch count.  On realistic networks only a handful of labels
+		survive per train, so the work stays close to linear in the number
+		of stops no matter how high the limit is.
+		"""
+		events = self.station_events()
+
+		#labels[t] is the frontier for reaching train t's current stop
+		#while riding train t, None until the train has been boarded
+		labels = [None] * len(self.trains)
+
+		i = 0
+		while i < len(events):
+			station = events[i][0]
+			j = i
+			while j < len(events) and events[j][0] == station:
+				j += 1
+
+			owners = []
+			arrivals = []
+			for e in xrange(i, j):
+				t = events[e][1]
+				if labels[t] is not None:
+					owners.append(t)
+					arrivals.append(labels[t])
+
+			if station == self.final_stop:
+				frontier = []
+				for arrival in arrivals:
+					frontier = _merge_labels(frontier, arrival)
+				return frontier
+
+			#same prefix/suffix trick as cheapest_path, on label lists
+			m = len(arrivals)
+			before = [[]]
+			for arrival in arrivals:
+				before.append(_merge_labels(before[-1], arrival))
+			after = [[]] * (m + 1)
+			for x in xrange(m - 1, -1, -1):
+				after[x] = _merge_labels(after[x + 1], arrivals[x])
+			slot = dict(zip(owners, xrange(m)))
+
+			for e in xrange(i, j):
+				t = events[e][1]
+				pos = events[e][2]
+				train = self.trains[t]
+				if pos + 1 >= len(train.stops):
+					labels[t] = None
+					continue
+
+				x = slot.get(t)
+				if x is None:
+					stay = []
+					other = before[m]
+				else:
+					stay = arrivals[x]
+					other = _merge_labels(before[x], after[x + 1])
+
+				#switching from another train costs one more switch
+				switched = [(k + 1, c) for k, c in other
+					if switchLimit is None or k < switchLimit]
+				board = _merge_labels(stay, switched)
+				if station == 0:
+					#passengers start here and may board any train for free
+					board = _merge_labels([(0, 0)], board)
+				if not board:
+					labels[t] = None
+					continue
+
+				leg = train.stops_dict[station]
+				labels[t] = [(k, c + leg) for k, c in board]
+
+			i = j
+
+		return []
+
+
+class UnitTests(unittest.TestCase):
+	"""
+	TrainRouter against a brute force search over (station, train,
+	switches) on small random networks.
+	"""
+
+	@staticmethod
+	def random_network(rng):
+		trains = []
+		for k in xrange(rng.randint(1, 4)):
+			stops = sorted(rng.sample(xrange(9), rng.randint(2, 5)))
+			if rng.random() < 0.6:
+				stops[0] = 0
+			stops = sorted(set(stops))
+			if len(stops) < 2:
+				stops = [0, rng.randint(1, 8)]
+			costs = [rng.randint(0, 9) for j in xrange(len(stops) - 1)]
+			trains.append(Train(len(stops), stops, costs, sum(costs)))
+		return trains, rng.randint(1, 8)
+
+	@staticmethod
+	def brute_force(trains, finalStop):
 		"""
-		find k shortest paths using djikstra, and
-		pick the one that contains a number of switches
-		less than the defined limit
+		cheapest cost to finalStop for every number of switches, as a dict
 		"""
-		A[0] = self.shortest_path()
+		best = {}
+		def ride(station, cost, current, switches):
+			if station == finalStop:
+				if cost < best.get(switches, float('inf')):
+					best[switches] = cost
+				return
+			for t, train in enumerate(trains):
+				if station in train.stops[:-1]:
+					j = train.stops.index(station)
+					ride(train.stops[j+1], cost + train.stops_dict[station], t,
+						switches + (current is not None and current != t))
+		ride(0, 0, None, 0)
+		return best
+
+	def test_CheapestPath(self):
+		rng = random.Random(7)
+		for n in xrange(300):
+			trains, finalStop = self.random_network(rng)
+			best = self.brute_force(trains, finalStop)
+			router = TrainRouter(finalStop, 0, trains)
+			for limit in xrange(5):
+				expected = min([cost for switches, cost in best.iteritems()
+					if switches <= limit] or [None])
+				self.assertEqual(router.cheapest_path(limit), expected)
+
+	def test_CostFrontier(self):
+		rng = random.Random(11)
+		for n in xrange(300):
+			trains, finalStop = self.random_network(rng)
+			best = self.brute_force(trains, finalStop)
+			frontier = []
+			for switches in sorted(best):
+				if not frontier or best[switches] < frontier[-1][1]:
+					frontier.append((switches, best[switches]))
+			router = TrainRouter(finalStop, 0, trains)
+			self.assertEqual([tuple(point) for point in router.cost_frontier()], frontier)
+			self.assertEqual([tuple(point) for point in router.cost_frontier(1)],
+				[point for point in frontier if point[0] <= 1])
 
 
 if __name__ == '__main__':
@@ -176,9 +546,13 @@ if __name__ == '__main__':
 	which here will be called switchLimit
 	"""
 
-	##instantiate our object to set up its internals
-	numLines, finalStop, switchLimit = sys.stdin.readline().strip().split()
-	tripPlanner = StationGraph(numLines, finalStop, switchLimit)
+	##only --itinerary walks the station graph, every other mode gets its
+	##answer from the TrainRouter, so the graph is only built for it
+	reader = TokenReader(sys.stdin)
+	numLines, finalStop, switchLimit = reader.line_ints()
+	tripPlanner = None
+	if '--itinerary' in sys.argv[1:]:
+		tripPlanner = StationGraph(numLines, finalStop, switchLimit)
 
 	"""
 	The next few lines will be read in groups of 3,
@@ -187,30 +561,47 @@ if __name__ == '__main__':
 	3rd line is list of costs per stop
 	"""
 	myTrains = list()
-	for i in xrange (0,tripPlanner.num_train_lines):
-		numstops = sys.stdin.readline().strip()
-		stopline = sys.stdin.readline().strip().split()
-		costline = sys.stdin.readline().strip().split()
+	for i in xrange (0,numLines):
+		numstops = reader.line_ints()[0]
+		stopline = reader.line_ints()
+		costline = reader.line_ints()
         ##pass in each station, what it points to, and its travel cost
 		costsum = 0
 
-		for j in xrange(0, int(numstops)-1):
-			#build the graph, one node at a time
-			costsum = costsum + int(costline[j])
-			tripPlanner.build_graph(
-				int(stopline[j]),
-				int(stopline[j+1]),
-				int(costline[j])
-			)
+		for j in xrange(0, numstops-1):
+			costsum = costsum + costline[j]
+			if tripPlanner is not None:
+				#build the graph, one node at a time
+				tripPlanner.build_graph(
+					stopline[j],
+					stopline[j+1],
+					costline[j],
+					i
+				)
 		#__init__(self, numstops, stoplist, costlist, solocost):
-		myTrains.append(Train(numstops, stopline, costline, costsum))
+		#some inputs carry a trailing cost for the last stop, drop it
+		myTrains.append(
+			Train(numstops, stopline, costline[:numstops-1], costsum)
+		)
 
 
 	"""
-	Now that the graph is built, call shortest_path to determine
-	the lowest cost from beginning to end.
+	Now that the trains are known, find the lowest cost from beginning to
+	end that stays within the switch limit.
 	"""
-	print tripPlanner.shortest_path()
+	router = TrainRouter(finalStop, switchLimit, myTrains)
+	if tripPlanner is not None:
+		#unlimited switches, with every leg and switch spelled out.
+		#--contract collapses single train runs before solving
+		if '--contract' in sys.argv[1:]:
+			tripPlanner.contract_chains()
+		print tripPlanner.shortest_path(itinerary=True)
+	elif '--frontier' in sys.argv[1:]:
+		#one "switches cost" line for every point on the Pareto frontier
+		for switches, cost in router.cost_frontier():
+			print switches, cost
+	else:
+		print router.cheapest_path()
 #	for train in myTrains:
 #		train.printMyDict()
 #		print "solo cost: ",
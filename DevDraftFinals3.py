@@ -1,6 +1,23 @@
 #pylint: disable=all
+import os
 import sys
+import time
+import json
+import atexit
+import signal
 import bisect
+import ctypes
+import itertools
+import struct
+import random
+import shutil
+import tempfile
+import traceback
+import unittest
+import multiprocessing
+import Queue
+from array import array
+from fastinput import TokenReader
 
 
 class MatchMakingPool(object):
@@ -141,6 +158,1423 @@ class MatchMakingPool(object):
         self.eloSum = self.eloSum + eloDiff
         self.matches = self.matches + 1
 
+    def poolSize(self):
+        """
+        number of players still waiting in the pool
+        """
+        return len(self.idList)
+
+    def waitingPlayers(self):
+        """
+        (playerID, playerElo) of every waiting player, lowest Elo first
+        """
+        return zip(self.idList, self.eloList)
+
+    def engineParameters(self):
+        """
+        settings besides eloThresh that change the results, a checkpoint
+        can only be resumed by a pool with the same ones
+        """
+        return {}
+
+    def restorePlayers(self, players):
+        """
+        Replace the pool with players, (playerID, playerElo) pairs lowest Elo
+        first as waitingPlayers returns them.  Used to resume from a
+        checkpoint, the lists are filled in one pass with no bisecting.
+        """
+        players = list(players)
+        del self.idList[:]
+        del self.eloList[:]
+        self.idList.extend(player[0] for player in players)
+        self.eloList.extend(player[1] for player in players)
+
+
+class PoolInstrumentation(object):
+    """
+    Counters and timers for the hot path of any pool engine.  attach(pool)
+    replaces the pool's methods on the instance with timed wrappers, so a
+    pool that was never attached runs its plain methods with no overhead
+    at all.  Attach right after constructing the pool, it works the same
+    for every engine.  Recorded:
+    - calls, total seconds and self seconds (total minus the time spent in
+      other instrumented methods) per method.  The self time of newLogon is
+      the bisect and neighbor checks, the self time of newLogoff is the
+      search for the player, and the list shifts show up under addPlayer
+      and removePlayer (or the engine's equivalents)
+    - a histogram of the pool size after each event, in power of two
+      buckets: "8" counts sizes 8 to 15
+    - matches per Elo difference bucket of diffBucket: "10" counts
+      differences 10 to 19 (with diffBucket 10)
+    """
+
+    METHODS = ('newLogon', 'newLogoff', 'addPlayer', 'removePlayer',
+        'removeKey', 'killKey', 'matchPlayer', 'matchKey', 'matchParty', 'compact')
+    EVENTS = ('newLogon', 'newLogoff')
+    MATCHES = ('matchPlayer', 'matchKey', 'matchParty')
+
+    def __init__(self, diffBucket=10):
+        self.diffBucket = max(int(diffBucket), 1)
+        self.calls = {}
+        self.seconds = {}
+        self.selfSeconds = {}
+        self.poolSizes = {}
+        self.matchDiffs = {}
+        self._childSeconds = 0.0
+
+    def attach(self, pool):
+        for name in self.METHODS:
+            method = getattr(pool, name, None)
+            if method is not None:
+                setattr(pool, name, self._wrap(pool, name, method))
+        pool.instrumentation = self
+        return pool
+
+    def _wrap(self, pool, name, method):
+        self.calls[name] = 0
+        self.seconds[name] = 0.0
+        self.selfSeconds[name] = 0.0
+        timer = time.time
+        isEvent = name in self.EVENTS
+        isMatch = name in self.MATCHES
+
+        def timed(*args):
+            outer = self._childSeconds
+            self._childSeconds = 0.0
+            start = timer()
+            try:
+                result = method(*args)
+            finally:
+                #even when method raises, the caller's child time must
+                #come back and include this call
+                elapsed = timer() - start
+                self.calls[name] += 1
+                self.seconds[name] += elapsed
+                self.selfSeconds[name] += elapsed - self._childSeconds
+                self._childSeconds = outer + elapsed
+            if isEvent:
+                size = pool.poolSize()
+                bucket = 1 << (size.bit_length() - 1) if size else 0
+                self.poolSizes[bucket] = self.poolSizes.get(bucket, 0) + 1
+            elif isMatch:
+                bucket = args[1] // self.diffBucket * self.diffBucket
+                self.matchDiffs[bucket] = self.matchDiffs.get(bucket, 0) + 1
+            return result
+        return timed
+
+    def report(self):
+        return {
+            'methods': dict((name, {
+                'calls': self.calls[name],
+                'seconds': self.seconds[name],
+                'selfSeconds': self.selfSeconds[name],
+            }) for name in self.calls),
+            'poolSizes': self.poolSizes,
+            'matchDiffs': self.matchDiffs,
+            'diffBucket': self.diffBucket,
+        }
+
+    def dump(self, path='-'):
+        """
+        write report() as JSON to path, or to stderr for '-'
+        """
+        text = json.dumps(self.report(), sort_keys=True) + "\n"
+        if path == '-':
+            sys.stderr.write(text)
+        else:
+            with open(path, 'w') as out:
+                out.write(text)
+
+
+class BlockedMatchMakingPool(object):
+    """
+    Same matchmaking rules as MatchMakingPool, but built to stay fast with
+    hundreds of thousands of waiting players.  The improvement suggested at
+    the bottom of this file, implemented with a blocked sorted list instead
+    of a hand written BST:
+
+    - Every waiting player gets one integer key, (elo << SEQ_BITS) + seq,
+      where seq counts logons.  Sorting by key is sorting by Elo, with ties
+      in logon order, which is exactly the order of MatchMakingPool's lists.
+    - The keys live in a list of sorted blocks of at most 2 * BLOCK_SIZE
+      keys, plus a list holding the last key of each block.  Finding a key
+      is a bisect over the block ends then a bisect inside one block, and
+      inserting or deleting only shifts one small block, so all of them are
+      O(log n) plus a small constant sized shift.
+    - playerIDs maps a key to its player id, and playerKeys maps a player id
+      to its keys.  That makes logoff a dict lookup instead of two scans.
+      A player id can be in the pool more than once, and logoff removes the
+      lowest key, the same entry idList.index would find.
+    """
+
+    BLOCK_SIZE = 512
+    SEQ_BITS = 40
+
+    def __init__(self, thresh):
+        self.eloThresh = thresh
+        self.matches = 0
+        self.eloSum = 0
+
+        self._blocks = []
+        self._maxes = []
+        self._size = 0
+        self._seq = 0
+        self.playerIDs = {}
+        self.playerKeys = {}
+
+    def _insert(self, key):
+        blocks = self._blocks
+        maxes = self._maxes
+        if not blocks:
+            blocks.append([key])
+            maxes.append(key)
+        else:
+            b = bisect.bisect_left(maxes, key)
+            if b == len(maxes):
+                #bigger than everything, goes at the end of the last block
+                b -= 1
+                blocks[b].append(key)
+            else:
+                bisect.insort(blocks[b], key)
+            block = blocks[b]
+            maxes[b] = block[-1]
+            if len(block) > 2 * self.BLOCK_SIZE:
+                #split the block in half to keep the shifts short
+                half = block[self.BLOCK_SIZE:]
+                del block[self.BLOCK_SIZE:]
+                blocks.insert(b + 1, half)
+                maxes[b] = block[-1]
+                maxes.insert(b + 1, half[-1])
+        self._size += 1
+
+    def _remove(self, key):
+        b = bisect.bisect_left(self._maxes, key)
+        block = self._blocks[b]
+        del block[bisect.bisect_left(block, key)]
+        if block:
+            self._maxes[b] = block[-1]
+        else:
+            del self._blocks[b]
+            del self._maxes[b]
+        self._size -= 1
+
+    def _lower(self, probe):
+        #largest key below probe, or None
+        b = bisect.bisect_left(self._maxes, probe)
+        if b < len(self._blocks):
+            block = self._blocks[b]
+            i = bisect.bisect_left(block, probe)
+            if i > 0:
+                return block[i-1]
+        if b > 0:
+            return self._blocks[b-1][-1]
+        return None
+
+    def _higher(self, probe):
+        #smallest key at or above probe, or None
+        b = bisect.bisect_left(self._maxes, probe)
+        if b == len(self._blocks):
+            return None
+        block = self._blocks[b]
+        return block[bisect.bisect_left(block, probe)]
+
+    def addPlayer(self, playerID, playerElo):
+        key = (playerElo << self.SEQ_BITS) + self._seq
+        self._seq += 1
+        self._insert(key)
+        self.playerIDs[key] = playerID
+        self.playerKeys.setdefault(playerID, []).append(key)
+
+    def removeKey(self, key):
+        """
+        remove the player holding key from the pool and from both indexes
+        """
+        self._remove(key)
+        playerID = self.playerIDs.pop(key)
+        keys = self.playerKeys[playerID]
+        keys.remove(key)
+        if not keys:
+            del self.playerKeys[playerID]
+
+    def newLogoff(self, playerID):
+        keys = self.playerKeys.get(playerID)
+        if keys:
+            self.removeKey(min(keys))
+
+    def newLogon(self, playerID, playerElo):
+        """
+        Same decision as MatchMakingPool.newLogon: the closest player within
+        threshold, the higher rated one when both sides are equally close.
+        Everything with Elo <= playerElo is below the probe key, so the two
+        neighbors are the keys on either side of it.
+        """
+        thresh = int(self.eloThresh)
+        probe = (playerElo + 1) << self.SEQ_BITS
+
+        lowDiff = None
+        lower = self._lower(probe)
+        if lower is not None:
+            lowDiff = playerElo - (lower >> self.SEQ_BITS)
+            if lowDiff > thresh:
+                lowDiff = None
+
+        highDiff = None
+        higher = self._higher(probe)
+        if higher is not None:
+            highDiff = (higher >> self.SEQ_BITS) - playerElo
+            if highDiff > thresh:
+                highDiff = None
+
+        if highDiff is not None and (lowDiff is None or highDiff <= lowDiff):
+            self.matchKey(higher, highDiff)
+        elif lowDiff is not None:
+            self.matchKey(lower, lowDiff)
+        else:
+            self.addPlayer(playerID, playerElo)
+
+    def matchKey(self, key, eloDiff):
+        self.removeKey(key)
+        self.eloSum = self.eloSum + eloDiff
+        self.matches = self.matches + 1
+
+    def poolSize(self):
+        return self._size
+
+    def waitingPlayers(self):
+        return [(self.playerIDs[key], key >> self.SEQ_BITS)
+            for block in self._blocks for key in block]
+
+    def engineParameters(self):
+        return {}
+
+    def restorePlayers(self, players):
+        """
+        Replace the pool with players, lowest Elo first.  The keys are
+        renumbered 0, 1, 2, ... in that order, which keeps the tie order,
+        and handed to _load already sorted.
+        """
+        self.playerIDs = {}
+        self.playerKeys = {}
+        keys = []
+        for seq, (playerID, playerElo) in enumerate(players):
+            key = (playerElo << self.SEQ_BITS) + seq
+            keys.append(key)
+            self.playerIDs[key] = playerID
+            self.playerKeys.setdefault(playerID, []).append(key)
+        self._seq = len(keys)
+        self._size = len(keys)
+        self._load(keys)
+
+    def _load(self, keys):
+        #cut the sorted keys into full blocks
+        self._blocks = [keys[i:i + self.BLOCK_SIZE]
+            for i in xrange(0, len(keys), self.BLOCK_SIZE)]
+        self._maxes = [block[-1] for block in self._blocks]
+
+
+class BucketMatchMakingPool(BlockedMatchMakingPool):
+    """
+    Every match has to be within eloThresh, so a new player can only ever
+    be matched with someone in its own bucket of width eloThresh or one of
+    the two buckets next to it.  This pool hashes the keys of
+    BlockedMatchMakingPool into those buckets (a dict of small sorted
+    lists) instead of keeping one big sorted structure.  The neighbor
+    lookups only look as far as the next bucket over: anything further
+    away is beyond the threshold anyway, so they may answer None where
+    the other pools would find a player, but newLogon makes exactly the
+    same decisions.  With buckets that stay small, logon and logoff are
+    expected O(1).
+    """
+
+    def __init__(self, thresh):
+        super(BucketMatchMakingPool, self).__init__(thresh)
+        self._width = max(int(thresh), 1)
+        self._buckets = {}
+
+    def _insert(self, key):
+        bucket = (key >> self.SEQ_BITS) // self._width
+        bisect.insort(self._buckets.setdefault(bucket, []), key)
+        self._size += 1
+
+    def _remove(self, key):
+        bucket = (key >> self.SEQ_BITS) // self._width
+        keys = self._buckets[bucket]
+        del keys[bisect.bisect_left(keys, key)]
+        if not keys:
+            del self._buckets[bucket]
+        self._size -= 1
+
+    def _lower(self, probe):
+        #largest key below probe in the probe's bucket or the one below it
+        bucket = ((probe >> self.SEQ_BITS) - 1) // self._width
+        keys = self._buckets.get(bucket)
+        if keys:
+            i = bisect.bisect_left(keys, probe)
+            if i > 0:
+                return keys[i-1]
+        keys = self._buckets.get(bucket - 1)
+        if keys:
+            return keys[-1]
+        return None
+
+    def _higher(self, probe):
+        #smallest key at or above probe in the probe's bucket or the next
+        bucket = ((probe >> self.SEQ_BITS) - 1) // self._width
+        keys = self._buckets.get(bucket)
+        if keys:
+            i = bisect.bisect_left(keys, probe)
+            if i < len(keys):
+                return keys[i]
+        keys = self._buckets.get(bucket + 1)
+        if keys:
+            return keys[0]
+        return None
+
+    def waitingPlayers(self):
+        return [(self.playerIDs[key], key >> self.SEQ_BITS)
+            for bucket in sorted(self._buckets) for key in self._buckets[bucket]]
+
+    def _load(self, keys):
+        #sorted keys stay sorted when appended bucket by bucket
+        self._buckets = {}
+        for key in keys:
+            self._buckets.setdefault((key >> self.SEQ_BITS) // self._width, []).append(key)
+
+
+class LazyLogoffPool(object):
+    """
+    Same matchmaking rules as MatchMakingPool, with tombstones.  Most
+    logoffs are for players who were already matched or never waited at
+    all, and a real logoff used to shift both lists.  Here a player leaving
+    the pool (by logoff or by being matched) is only marked dead: idList
+    sits next to keyList, which holds the same (elo << SEQ_BITS) + seq keys
+    as BlockedMatchMakingPool, and a key in the dead set is a tombstone.  newLogon walks outward from the bisect point past any
+    tombstones to the nearest live players.  Once the dead fraction of
+    keyList goes over deadRatio, both lists are rebuilt without the
+    tombstones in one linear pass, so many O(n) shifts become occasional
+    O(n) rebuilds.  stats() reports how that is going.
+    """
+
+    SEQ_BITS = BlockedMatchMakingPool.SEQ_BITS
+    #never bother compacting lists shorter than this
+    MIN_COMPACT = 64
+
+    def __init__(self, thresh, deadRatio=0.25):
+        self.eloThresh = thresh
+        self.matches = 0
+        self.eloSum = 0
+        self.deadRatio = float(deadRatio)
+        self.idList = []
+        self.keyList = []
+        self.dead = set()
+        self.playerKeys = {}
+        self.compactions = 0
+        self._seq = 0
+
+    def addPlayer(self, playerID, playerElo, index):
+        key = (playerElo << self.SEQ_BITS) + self._seq
+        self._seq += 1
+        self.keyList.insert(index, key)
+        self.idList.insert(index, playerID)
+        self.playerKeys.setdefault(playerID, []).append(key)
+
+    def killKey(self, key, playerID):
+        """
+        tombstone a waiting player, compacting the lists if it is time to
+        """
+        keys = self.playerKeys[playerID]
+        keys.remove(key)
+        if not keys:
+            del self.playerKeys[playerID]
+        self.dead.add(key)
+        if (len(self.keyList) >= self.MIN_COMPACT and
+                len(self.dead) > self.deadRatio * len(self.keyList)):
+            self.compact()
+
+    def compact(self):
+        """
+        rebuild both lists without the tombstones
+        """
+        dead = self.dead
+        live = [i for i, key in enumerate(self.keyList) if not key in dead]
+        self.keyList = [self.keyList[i] for i in live]
+        self.idList = [self.idList[i] for i in live]
+        self.dead = set()
+        self.compactions += 1
+
+    def newLogoff(self, playerID):
+        keys = self.playerKeys.get(playerID)
+        if keys:
+            #the lowest key is the entry idList.index would have found
+            self.killKey(min(keys), playerID)
+
+    def newLogon(self, playerID, playerElo):
+        """
+        Same decision as MatchMakingPool.newLogon, skipping tombstones on
+        the way to the nearest live player on either side.
+        """
+        thresh = int(self.eloThresh)
+        keyList = self.keyList
+        dead = self.dead
+        indexToInsert = bisect.bisect_left(keyList, (playerElo + 1) << self.SEQ_BITS)
+
+        lowDiff = None
+        low = indexToInsert - 1
+        while low >= 0 and keyList[low] in dead:
+            low -= 1
+        if low >= 0:
+            lowDiff = playerElo - (keyList[low] >> self.SEQ_BITS)
+            if lowDiff > thresh:
+                lowDiff = None
+
+        highDiff = None
+        high = indexToInsert
+        while high < len(keyList) and keyList[high] in dead:
+            high += 1
+        if high < len(keyList):
+            highDiff = (keyList[high] >> self.SEQ_BITS) - playerElo
+            if highDiff > thresh:
+                highDiff = None
+
+        if highDiff is not None and (lowDiff is None or highDiff <= lowDiff):
+            self.matchPlayer(high, highDiff)
+        elif lowDiff is not None:
+            self.matchPlayer(low, lowDiff)
+        else:
+            self.addPlayer(playerID, playerElo, indexToInsert)
+
+    def matchPlayer(self, index, eloDiff):
+        self.killKey(self.keyList[index], self.idList[index])
+        self.eloSum = self.eloSum + eloDiff
+        self.matches = self.matches + 1
+
+    def poolSize(self):
+        return len(self.keyList) - len(self.dead)
+
+    def waitingPlayers(self):
+        dead = self.dead
+        return [(playerID, key >> self.SEQ_BITS)
+            for playerID, key in zip(self.idList, self.keyList) if not key in dead]
+
+    def engineParameters(self):
+        #deadRatio only changes when the lists are compacted
+        return {}
+
+    def restorePlayers(self, players):
+        players = list(players)
+        self.keyList = [(playerElo << self.SEQ_BITS) + seq
+            for seq, (playerID, playerElo) in enumerate(players)]
+        self.idList = [playerID for playerID, playerElo in players]
+        self.dead = set()
+        self.playerKeys = {}
+        for playerID, key in zip(self.idList, self.keyList):
+            self.playerKeys.setdefault(playerID, []).append(key)
+        self._seq = len(self.keyList)
+
+    def stats(self):
+        return {
+            'waiting': self.poolSize(),
+            'tombstones': len(self.dead),
+            'deadFraction': len(self.dead) / float(max(len(self.keyList), 1)),
+            'deadRatio': self.deadRatio,
+            'compactions': self.compactions,
+        }
+
+
+class ArrayMatchMakingPool(MatchMakingPool):
+    """
+    MatchMakingPool with its two lists stored as typed arrays, so every id
+    and Elo is a raw machine integer instead of a pointer to a boxed Python
+    int.  array supports insert, pop, index and bisect just like a list, so
+    every method is inherited unchanged.  The arrays over-allocate as they
+    grow, a chunk at a time, the same way lists do.
+    With the default 'l' typecode (8 bytes on 64 bit Linux) a waiting
+    player costs about 16 bytes plus slack, against roughly 80 for two
+    list slots pointing at two int objects.  Use typecode 'i' to halve that
+    when every id and Elo fits in 32 bits.
+    """
+
+    def __init__(self, thresh, typecode='l'):
+        super(ArrayMatchMakingPool, self).__init__(thresh)
+        self.idList = array(typecode)
+        self.eloList = array(typecode)
+
+    def memoryPerPlayer(self):
+        """
+        bytes used by the two arrays (including growth slack) per waiting
+        player, None for an empty pool
+        """
+        if not self.idList:
+            return None
+        return (sys.getsizeof(self.idList) + sys.getsizeof(self.eloList)) / \
+            float(len(self.idList))
+
+    def stats(self):
+        return {
+            'waiting': self.poolSize(),
+            'bytesPerPlayer': self.memoryPerPlayer(),
+        }
+
+
+class PartyMatchMakingPool(MatchMakingPool):
+    """
+    MatchMakingPool for lobbies of partySize players instead of 1v1.  A
+    lobby forms as soon as partySize waiting players (the new one included)
+    fit inside an Elo span of eloThresh.
+    Every group worth looking at is a run of consecutive players in the
+    sorted lists with the new player in it, so there are only partySize
+    candidate windows: the ones starting up to partySize - 1 slots below
+    the bisect point.  The spread of a window is its highest Elo minus its
+    lowest, the tightest window within threshold wins (the higher one on a
+    tie, like newLogon), its players are removed with one slice and its
+    spread is added to eloSum.  matches counts lobbies.  That is O(partySize
+    + log n) to decide plus one shift of the lists, and with partySize 2 it
+    is exactly the 1v1 pool.
+    """
+
+    def __init__(self, thresh, partySize=2):
+        super(PartyMatchMakingPool, self).__init__(thresh)
+        if partySize < 2:
+            raise ValueError("a party needs at least 2 players")
+        self.partySize = partySize
+
+    def engineParameters(self):
+        return {'partySize': self.partySize}
+
+    def newLogon(self, playerID, playerElo):
+        thresh = int(self.eloThresh)
+        eloList = self.eloList
+        indexToInsert = bisect.bisect(eloList, playerElo)
+        #the other partySize - 1 players of a window are eloList[first:last]
+        others = self.partySize - 1
+
+        bestFirst = None
+        bestSpread = None
+        for first in xrange(max(indexToInsert - others, 0), indexToInsert + 1):
+            last = first + others
+            if last > len(eloList):
+                break
+            lowest = eloList[first] if first < indexToInsert else playerElo
+            highest = eloList[last-1] if last > indexToInsert else playerElo
+            spread = highest - lowest
+            if spread <= thresh and (bestSpread is None or spread <= bestSpread):
+                bestFirst = first
+                bestSpread = spread
+
+        if bestFirst is None:
+            self.addPlayer(playerID, playerElo, indexToInsert)
+        else:
+            self.matchParty(bestFirst, bestSpread)
+
+    def matchParty(self, first, spread):
+        """
+        remove the waiting players of a lobby, they are the partySize - 1
+        players starting at index first
+        """
+        last = first + self.partySize - 1
+        del self.idList[first:last]
+        del self.eloList[first:last]
+        self.eloSum = self.eloSum + spread
+        self.matches = self.matches + 1
+
+
+class _AcceptNode(object):
+    """
+    treap node for WideningMatchMakingPool.  low and high are the player's
+    acceptance bounds with the widening of the current bucket left out,
+    lowMax and highMin aggregate them over the node's subtree, joined is
+    the bucket the player started waiting in
+    """
+    __slots__ = ('key', 'priority', 'left', 'right', 'low', 'high', 'lowMax',
+        'highMin', 'joined')
+
+    def __init__(self, key, priority, low, high, joined):
+        self.key = key
+        self.priority = priority
+        self.joined = joined
+        self.left = None
+        self.right = None
+        self.low = self.lowMax = low
+        self.high = self.highMin = high
+
+    def update(self):
+        lowMax = self.low
+        highMin = self.high
+        if self.left is not None:
+            lowMax = max(lowMax, self.left.lowMax)
+            highMin = min(highMin, self.left.highMin)
+        if self.right is not None:
+            lowMax = max(lowMax, self.right.lowMax)
+            highMin = min(highMin, self.right.highMin)
+        self.lowMax = lowMax
+        self.highMin = highMin
+
+
+class WideningMatchMakingPool(object):
+    """
+    Matchmaking where a waiting player's threshold grows the longer they
+    wait, so outliers eventually find someone.  Time is counted in events
+    (every logon and logoff is one tick) and grouped into buckets of
+    widenEvery ticks: a player who joined in bucket b accepts anyone within
+    eloThresh + widenBy * (current bucket - b) of their Elo.  A new player
+    is matched with the closest waiting player that accepts them, the
+    higher rated one on a tie.  With widenBy 0 this is MatchMakingPool.
+
+    The waiting players are keyed like BlockedMatchMakingPool, (elo <<
+    SEQ_BITS) + seq, in a treap.  Whether a player with Elo e who joined in
+    bucket b accepts x at bucket c is
+        below x:  e - widenBy * b >= x - eloThresh - widenBy * c
+        above x:  e + widenBy * b <= x + eloThresh + widenBy * c
+    The left hand sides never change, so every node stores them and the
+    max / min of them over its subtree.  The nearest acceptor on each side
+    is then one walk down the treap that skips subtrees with nobody in
+    them, O(log n), and widening costs nothing: only the right hand sides
+    move with the clock.
+    """
+
+    SEQ_BITS = BlockedMatchMakingPool.SEQ_BITS
+
+    def __init__(self, thresh, widenBy=0, widenEvery=1000):
+        self.eloThresh = thresh
+        self.widenBy = widenBy
+        self.widenEvery = max(int(widenEvery), 1)
+        self.matches = 0
+        self.eloSum = 0
+
+        self.clock = 0
+        self._root = None
+        self._size = 0
+        self._seq = 0
+        self._random = random.Random(0)
+        self.playerIDs = {}
+        self.playerKeys = {}
+
+    def bucket(self):
+        return self.clock // self.widenEvery
+
+    def _split(self, node, key):
+        #(keys below key, keys at or above key)
+        if node is None:
+            return None, None
+        if node.key < key:
+            node.right, right = self._split(node.right, key)
+            node.update()
+            return node, right
+        left, node.left = self._split(node.left, key)
+        node.update()
+        return left, node
+
+    def _merge(self, left, right):
+        #every key in left is below every key in right
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            left.update()
+            return left
+        right.left = self._merge(left, right.left)
+        right.update()
+        return right
+
+    def _lowerAcceptor(self, node, probe, bound):
+        #node with the largest key below probe and low >= bound, or None
+        if node is None or node.lowMax < bound:
+            return None
+        if node.key >= probe:
+            return self._lowerAcceptor(node.left, probe, bound)
+        found = self._lowerAcceptor(node.right, probe, bound)
+        if found is None and node.low >= bound:
+            found = node
+        if found is None:
+            found = self._lowerAcceptor(node.left, probe, bound)
+        return found
+
+    def _higherAcceptor(self, node, probe, bound):
+        #node with the smallest key at or above probe and high <= bound, or None
+        if node is None or node.highMin > bound:
+            return None
+        if node.key < probe:
+            return self._higherAcceptor(node.right, probe, bound)
+        found = self._higherAcceptor(node.left, probe, bound)
+        if found is None and node.high <= bound:
+            found = node
+        if found is None:
+            found = self._higherAcceptor(node.right, probe, bound)
+        return found
+
+    def addPlayer(self, playerID, playerElo, joined=None):
+        if joined is None:
+            joined = self.bucket()
+        key = (playerElo << self.SEQ_BITS) + self._seq
+        self._seq += 1
+        widened = self.widenBy * joined
+        node = _AcceptNode(key, self._random.random(),
+            playerElo - widened, playerElo + widened, joined)
+        left, right = self._split(self._root, key)
+        self._root = self._merge(self._merge(left, node), right)
+        self._size += 1
+        self.playerIDs[key] = playerID
+        self.playerKeys.setdefault(playerID, []).append(key)
+
+    def removeKey(self, key):
+        left, rest = self._split(self._root, key)
+        node, right = self._split(rest, key + 1)
+        self._root = self._merge(left, right)
+        self._size -= 1
+        playerID = self.playerIDs.pop(key)
+        keys = self.playerKeys[playerID]
+        keys.remove(key)
+        if not keys:
+            del self.playerKeys[playerID]
+
+    def newLogoff(self, playerID):
+        keys = self.playerKeys.get(playerID)
+        if keys:
+            self.removeKey(min(keys))
+        self.clock += 1
+
+    def newLogon(self, playerID, playerElo):
+        reach = int(self.eloThresh) + self.widenBy * self.bucket()
+        probe = (playerElo + 1) << self.SEQ_BITS
+
+        lowDiff = None
+        lower = self._lowerAcceptor(self._root, probe, playerElo - reach)
+        if lower is not None:
+            lowDiff = playerElo - (lower.key >> self.SEQ_BITS)
+
+        highDiff = None
+        higher = self._higherAcceptor(self._root, probe, playerElo + reach)
+        if higher is not None:
+            highDiff = (higher.key >> self.SEQ_BITS) - playerElo
+
+        if highDiff is not None and (lowDiff is None or highDiff <= lowDiff):
+            self.matchKey(higher.key, highDiff)
+        elif lowDiff is not None:
+            self.matchKey(lower.key, lowDiff)
+        else:
+            self.addPlayer(playerID, playerElo)
+        self.clock += 1
+
+    def matchKey(self, key, eloDiff):
+        self.removeKey(key)
+        self.eloSum = self.eloSum + eloDiff
+        self.matches = self.matches + 1
+
+    def poolSize(self):
+        return self._size
+
+    def _waitingNodes(self):
+        #every node, lowest key first
+        nodes = []
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            if node is not None:
+                stack.append(node)
+                node = node.left
+            else:
+                node = stack.pop()
+                nodes.append(node)
+                node = node.right
+        return nodes
+
+    def waitingPlayers(self):
+        return [(self.playerIDs[node.key], node.key >> self.SEQ_BITS)
+            for node in self._waitingNodes()]
+
+    def engineParameters(self):
+        return {'widenBy': self.widenBy, 'widenEvery': self.widenEvery}
+
+    def checkpointState(self):
+        """
+        what a checkpoint needs beyond the waiting players: the clock, and
+        the bucket each waiting player joined in (in waitingPlayers order)
+        """
+        return {'clock': self.clock}, {'joined': [node.joined for node in self._waitingNodes()]}
+
+    def restorePlayers(self, players, joined=None):
+        """
+        Replace the pool with players, lowest Elo first, who joined in the
+        buckets listed in joined (the current bucket if it is not given).
+        """
+        self._root = None
+        self._size = 0
+        self.playerIDs = {}
+        self.playerKeys = {}
+        if joined is None:
+            joined = [self.bucket()] * len(players)
+        for (playerID, playerElo), bucket in zip(players, joined):
+            self.addPlayer(playerID, playerElo, bucket)
+
+    def stats(self):
+        return {
+            'waiting': self.poolSize(),
+            'clock': self.clock,
+            'bucket': self.bucket(),
+            'reach': int(self.eloThresh) + self.widenBy * self.bucket(),
+        }
+
+
+#pool backends that can be picked with --engine on the command line
+POOL_ENGINES = {
+    'list': MatchMakingPool,
+    'blocked': BlockedMatchMakingPool,
+    'bucket': BucketMatchMakingPool,
+    'lazy': LazyLogoffPool,
+    'array': ArrayMatchMakingPool,
+    'party': PartyMatchMakingPool,
+    'widening': WideningMatchMakingPool,
+}
+
+#constructor options, besides the threshold, that each engine takes
+ENGINE_OPTIONS = {
+    'lazy': ('deadRatio',),
+    'party': ('partySize',),
+    'widening': ('widenBy', 'widenEvery'),
+}
+
+
+#checkpoint file: header, then metaSize bytes of JSON with the engine's
+#parameters, its extra state and the names of its extra columns, then the
+#ids and the Elos of the waiting players (lowest Elo first) and each extra
+#column, all as runs of count little endian int64.  Version 1 files have
+#no metadata (and the header ends with count)
+CHECKPOINT_MAGIC = 'DDMP'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_HEADER_V1 = struct.Struct('<4sIqqqqqq')
+CHECKPOINT_HEADER = struct.Struct('<4sIqqqqqqI')
+
+
+def saveCheckpoint(pool, path, eventIndex=0, offset=0):
+    """
+    Write the waiting players and the counters of pool to path, along with
+    where in the event log the pool is: eventIndex events have been
+    applied and the next one starts at byte offset.  Engines that keep
+    more than that (the widening engine's clock and join buckets) hand it
+    over with checkpointState.  The file is written next to path and
+    renamed over it, so a crash while saving leaves the previous
+    checkpoint intact.
+    """
+    players = pool.waitingPlayers()
+    count = len(players)
+    state, columns = {}, {}
+    if hasattr(pool, 'checkpointState'):
+        state, columns = pool.checkpointState()
+    meta = json.dumps({'parameters': pool.engineParameters(), 'state': state,
+        'columns': sorted(columns)}, sort_keys=True)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as checkpoint:
+        checkpoint.write(CHECKPOINT_HEADER.pack(
+            CHECKPOINT_MAGIC, CHECKPOINT_VERSION, int(pool.eloThresh),
+            pool.matches, pool.eloSum, eventIndex, offset, count, len(meta)))
+        checkpoint.write(meta)
+        runs = [[player[0] for player in players], [player[1] for player in players]]
+        runs.extend(columns[name] for name in sorted(columns))
+        for run in runs:
+            checkpoint.write(buffer((ctypes.c_int64 * count)(*run)))
+    os.rename(temp, path)
+
+
+def loadCheckpoint(path, engine='list', **options):
+    """
+    Rebuild a pool of the given engine from a checkpoint written by
+    saveCheckpoint.  Returns (pool, eventIndex, offset): replaying the log
+    from byte offset on gives the same results as replaying all of it.
+    The engine's parameters (partySize, widenBy, ...) have to be the ones
+    the checkpoint was taken with, or ValueError is raised.  Restoring
+    takes time proportional to the number of waiting players (times log n
+    for the widening engine), however long the log that built them was.
+    """
+    with open(path, 'rb') as checkpoint:
+        data = checkpoint.read()
+    if len(data) < CHECKPOINT_HEADER_V1.size or data[:4] != CHECKPOINT_MAGIC:
+        raise ValueError("%s is not a matchmaking checkpoint" % path)
+    version = struct.unpack_from('<I', data, 4)[0]
+    if version == 1:
+        header = CHECKPOINT_HEADER_V1
+        magic, version, thresh, matches, eloSum, eventIndex, offset, count = \
+            header.unpack_from(data)
+        metaSize = 0
+        meta = {'parameters': {}, 'state': {}, 'columns': []}
+    elif version == CHECKPOINT_VERSION:
+        header = CHECKPOINT_HEADER
+        if len(data) < header.size:
+            raise ValueError("%s is truncated" % path)
+        magic, version, thresh, matches, eloSum, eventIndex, offset, count, metaSize = \
+            header.unpack_from(data)
+        meta = json.loads(data[header.size:header.size + metaSize])
+    else:
+        raise ValueError("unsupported checkpoint version %d in %s" % (version, path))
+    start = header.size + metaSize
+    runs = 2 + len(meta['columns'])
+    if len(data) != start + 8 * runs * count:
+        raise ValueError("%s is truncated" % path)
+
+    pool = POOL_ENGINES[engine](thresh, **options)
+    parameters = pool.engineParameters()
+    if parameters != meta['parameters']:
+        raise ValueError("the checkpoint was taken with engine parameters %s, not %s" % (
+            json.dumps(meta['parameters'], sort_keys=True),
+            json.dumps(parameters, sort_keys=True)))
+
+    values = [(ctypes.c_int64 * count).from_buffer_copy(data, start + 8 * count * run)
+        for run in xrange(runs)]
+    for name, value in meta['state'].iteritems():
+        setattr(pool, str(name), value)
+    columns = dict((str(name), list(column))
+        for name, column in zip(meta['columns'], values[2:]))
+    pool.restorePlayers(zip(values[0], values[1]), **columns)
+    pool.matches = matches
+    pool.eloSum = eloSum
+    return pool, eventIndex, offset
+
+
+def readEvents(reader, num_events):
+    """
+    Decode num_events events into three flat arrays: logons (1 for logon,
+    0 for logoff), player ids and Elos (0 for logoffs).  Parsing once
+    lets any number of pools replay the same log.
+    """
+    logons = array('b')
+    ids = array('l')
+    elos = array('l')
+    for i in xrange(num_events):
+        playerAction = reader.next_token().lower()
+        ids.append(reader.next_int())
+        if playerAction == "logon":
+            logons.append(1)
+            elos.append(reader.next_int())
+        else:
+            logons.append(0)
+            elos.append(0)
+    return logons, ids, elos
+
+
+def replay(pool, events):
+    """
+    feed decoded events through a pool, returns the pool
+    """
+    logons, ids, elos = events
+    newLogon = pool.newLogon
+    newLogoff = pool.newLogoff
+    for i in xrange(len(ids)):
+        if logons[i]:
+            newLogon(ids[i], elos[i])
+        else:
+            newLogoff(ids[i])
+    return pool
+
+
+#events shared with the worker processes of replayThresholds, set before
+#the pool forks so the children read the parent's pages instead of copies
+_replayEvents = None
+
+
+def _replayOne(job):
+    engine, thresh, options = job
+    pool = replay(POOL_ENGINES[engine](thresh, **options), _replayEvents)
+    return thresh, pool.matches, pool.eloSum, pool.poolSize()
+
+
+def replayThresholds(events, thresholds, engine='list', workers=1, options=None):
+    """
+    What-if replay: run one independent pool per threshold over the same
+    decoded events and return (threshold, matches, eloSum, pool size) for
+    each, in the order given.  options are passed to every pool's
+    constructor.  With more than one worker the pools are spread over that
+    many processes.
+    """
+    global _replayEvents
+    _replayEvents = events
+    jobs = [(engine, thresh, options or {}) for thresh in thresholds]
+    if workers is not None and workers <= 1:
+        return map(_replayOne, jobs)
+    workerPool = multiprocessing.Pool(workers)
+    try:
+        return workerPool.map(_replayOne, jobs, 1)
+    finally:
+        workerPool.close()
+        workerPool.join()
+
+
+def _shardWorker(engine, thresh, inbox, outbox, options):
+    """
+    Body of one shard process.  Batches of raw event lines arrive on inbox
+    in order, every queue gets its own pool, and at the end (a None batch)
+    the totals of each queue are sent back on outbox as ('totals', {queue:
+    totals}).  Parsing the lines here rather than in the router keeps the
+    router from becoming the bottleneck.  If anything goes wrong the
+    traceback is sent back as ('error', text) right away, and the rest of
+    the batches are drained so the router never blocks on a full inbox.
+    """
+    pools = {}
+    batch = []
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            for line in batch:
+                splitline = line.split()
+                queue = splitline[0]
+                pool = pools.get(queue)
+                if pool is None:
+                    pool = pools[queue] = POOL_ENGINES[engine](thresh, **options)
+                if splitline[1].lower() == "logon":
+                    pool.newLogon(int(splitline[2]), int(splitline[3]))
+                else:
+                    pool.newLogoff(int(splitline[2]))
+    except Exception:
+        outbox.put(('error', traceback.format_exc()))
+        while batch is not None:
+            batch = inbox.get()
+        return
+    outbox.put(('totals', dict((queue, (pool.matches, pool.eloSum, pool.poolSize()))
+        for queue, pool in pools.iteritems())))
+
+
+def _shardFailed(shards):
+    raise RuntimeError("%d of %d shard workers died" % (
+        sum(1 for shard in shards if not shard.is_alive()), len(shards)))
+
+
+def runSharded(reader, num_events, thresh, engine='list', workers=None,
+        batchSize=4096, options=None):
+    """
+    Matchmaking for a stream that is really many independent queues.  Each
+    event carries a queue key in front: "QUEUE logon id elo" or "QUEUE
+    logoff id".  Every queue is owned by one of the worker processes
+    (picked by hashing the key), and this process only parses and routes
+    events in batches, so events of a queue are applied in their original
+    order while different queues run on different cores.
+    Returns {queue: (matches, eloSum, pool size)}.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    outbox = multiprocessing.Queue()
+    inboxes = []
+    shards = []
+    for w in xrange(workers):
+        inbox = multiprocessing.Queue(64)
+        shard = multiprocessing.Process(target=_shardWorker,
+            args=(engine, thresh, inbox, outbox, options or {}))
+        shard.daemon = True
+        shard.start()
+        inboxes.append(inbox)
+        shards.append(shard)
+
+    def send(w, batch):
+        #never block for good on a shard that is gone
+        while True:
+            try:
+                inboxes[w].put(batch, timeout=1)
+                return
+            except Queue.Full:
+                if not shards[w].is_alive():
+                    _shardFailed(shards)
+
+    #the router only looks at the queue key, the rest of the line is
+    #passed through untouched
+    batches = [[] for w in xrange(workers)]
+    for i in xrange(num_events):
+        line = reader.line()
+        while line == '':
+            #the rest of the header line, or a blank line
+            line = reader.line()
+        if line is None:
+            break
+        w = hash(line.split(None, 1)[0]) % workers
+        batches[w].append(line)
+        if len(batches[w]) >= batchSize:
+            send(w, batches[w])
+            batches[w] = []
+
+    for w in xrange(workers):
+        if batches[w]:
+            send(w, batches[w])
+        send(w, None)
+
+    #wait for every shard's totals, a shard that failed sends its
+    #traceback instead, and one that died without a word is noticed by
+    #polling is_alive
+    totals = {}
+    received = 0
+    while received < workers:
+        try:
+            kind, result = outbox.get(timeout=1)
+        except Queue.Empty:
+            if not all(shard.is_alive() for shard in shards):
+                _shardFailed(shards)
+            continue
+        if kind == 'error':
+            raise RuntimeError("a shard worker failed:\n" + result)
+        totals.update(result)
+        received += 1
+    for shard in shards:
+        shard.join()
+    return totals
+
+
+class UnitTests(unittest.TestCase):
+    """
+    Every engine against MatchMakingPool on seeded random streams, checked
+    after every event, the party and widening rules against brute force
+    searches, and checkpoints resumed halfway through a log.
+    """
+
+    class SmallBlockPool(BlockedMatchMakingPool):
+        #splits and empty blocks after a handful of players
+        BLOCK_SIZE = 2
+
+    class EagerLazyPool(LazyLogoffPool):
+        #compacts almost every time somebody leaves
+        MIN_COMPACT = 2
+
+    @staticmethod
+    def randomStream(rng, numEvents, numIDs, lowElo, highElo):
+        """
+        (logon, playerID, playerElo) events, ids repeat so the same player
+        can wait more than once and log off twice
+        """
+        events = []
+        for i in xrange(numEvents):
+            playerID = rng.randint(0, numIDs - 1)
+            if rng.random() < 0.65:
+                events.append((True, playerID, rng.randint(lowElo, highElo)))
+            else:
+                events.append((False, playerID, 0))
+        return events
+
+    def assertSamePools(self, pool, reference):
+        self.assertEqual(pool.matches, reference.matches)
+        self.assertEqual(pool.eloSum, reference.eloSum)
+        self.assertEqual(pool.poolSize(), reference.poolSize())
+        self.assertEqual(list(pool.waitingPlayers()), list(reference.waitingPlayers()))
+
+    def test_EnginesMatchList(self):
+        rng = random.Random(11)
+        factories = [(name, POOL_ENGINES[name]) for name in sorted(POOL_ENGINES)]
+        factories.append(('small blocks', self.SmallBlockPool))
+        factories.append(('eager lazy', self.EagerLazyPool))
+        factories.append(('lazy 0.9', lambda thresh: LazyLogoffPool(thresh, deadRatio=0.9)))
+        for n in xrange(24):
+            thresh = rng.choice([0, 1, 3, 10, 40])
+            events = self.randomStream(rng, 400, rng.choice([5, 40, 400]),
+                rng.choice([-100, -5, 0]), rng.choice([5, 50, 200]))
+            reference = MatchMakingPool(thresh)
+            pools = [(name, factory(thresh)) for name, factory in factories]
+            for logon, playerID, playerElo in events:
+                if logon:
+                    reference.newLogon(playerID, playerElo)
+                else:
+                    reference.newLogoff(playerID)
+                for name, pool in pools:
+                    if logon:
+                        pool.newLogon(playerID, playerElo)
+                    else:
+                        pool.newLogoff(playerID)
+                    self.assertSamePools(pool, reference)
+
+
+    @staticmethod
+    def bruteForceParty(events, thresh, partySize):
+        """
+        Lobbies picked from every combination of waiting players: the
+        tightest spread within thresh, and on a tie the highest window,
+        which is the one whose lowest player is highest (the new player
+        sorting after equal Elos) followed by the lowest other players.
+        Returns (matches, eloSum, waiting players).
+        """
+        waiting = []
+        matches = eloSum = 0
+        for seq, (logon, playerID, playerElo) in enumerate(events):
+            if not logon:
+                mine = [player for player in waiting if player[2] == playerID]
+                if mine:
+                    waiting.remove(min(mine))
+                continue
+            newPlayer = (playerElo, float('inf'), playerID)
+            best = None
+            for others in itertools.combinations(sorted(waiting), partySize - 1):
+                lobby = sorted(others + (newPlayer,))
+                spread = lobby[-1][0] - lobby[0][0]
+                if spread > thresh:
+                    continue
+                rank = (-spread, lobby[0][:2], [(-player[0], -player[1]) for player in lobby[1:]])
+                if best is None or rank > best[0]:
+                    best = (rank, others, spread)
+            if best is None:
+                waiting.append((playerElo, seq, playerID))
+            else:
+                for player in best[1]:
+                    waiting.remove(player)
+                matches += 1
+                eloSum += best[2]
+        return matches, eloSum, [(playerID, playerElo)
+            for playerElo, seq, playerID in sorted(waiting)]
+
+    def test_PartyBruteForce(self):
+        rng = random.Random(20)
+        for n in xrange(150):
+            thresh = rng.choice([0, 2, 5, 12])
+            partySize = rng.choice([2, 3, 4])
+            events = self.randomStream(rng, 60, rng.choice([4, 30]), 0, rng.choice([10, 40]))
+            pool = PartyMatchMakingPool(thresh, partySize)
+            for logon, playerID, playerElo in events:
+                if logon:
+                    pool.newLogon(playerID, playerElo)
+                else:
+                    pool.newLogoff(playerID)
+            self.assertEqual((pool.matches, pool.eloSum, pool.waitingPlayers()),
+                self.bruteForceParty(events, thresh, partySize))
+
+
+    @staticmethod
+    def bruteForceWidening(events, thresh, widenBy, widenEvery):
+        """
+        Scan every waiting player for the ones who accept the new player,
+        eloThresh + widenBy * (bucket - joined) away at most, and take the
+        closest, the higher rated side on a tie.  On the same side the
+        latest logon below the new player wins and the earliest above, the
+        order MatchMakingPool's lists give.  Every event is one tick.
+        Returns (matches, eloSum, waiting players).
+        """
+        waiting = []
+        matches = eloSum = 0
+        for clock, (logon, playerID, playerElo) in enumerate(events):
+            if not logon:
+                mine = [player for player in waiting if player[2] == playerID]
+                if mine:
+                    waiting.remove(min(mine))
+                continue
+            bucket = clock // widenEvery
+            acceptors = [player for player in waiting
+                if abs(player[0] - playerElo) <= thresh + widenBy * (bucket - player[3])]
+            lower = max([player for player in acceptors if player[0] <= playerElo] or [None])
+            higher = min([player for player in acceptors if player[0] > playerElo] or [None])
+            if higher is not None and (lower is None or
+                    higher[0] - playerElo <= playerElo - lower[0]):
+                match = higher
+            else:
+                match = lower
+            if match is None:
+                waiting.append((playerElo, clock, playerID, bucket))
+            else:
+                waiting.remove(match)
+                matches += 1
+                eloSum += abs(match[0] - playerElo)
+        return matches, eloSum, [(playerID, playerElo)
+            for playerElo, seq, playerID, joined in sorted(waiting)]
+
+    def test_WideningBruteForce(self):
+        rng = random.Random(21)
+        for n in xrange(150):
+            thresh = rng.choice([0, 3, 10])
+            widenBy = rng.choice([1, 2, 7])
+            widenEvery = rng.choice([1, 3, 10])
+            events = self.randomStream(rng, 120, rng.choice([6, 60]), -20, rng.choice([20, 150]))
+            pool = WideningMatchMakingPool(thresh, widenBy, widenEvery)
+            for logon, playerID, playerElo in events:
+                if logon:
+                    pool.newLogon(playerID, playerElo)
+                else:
+                    pool.newLogoff(playerID)
+            self.assertEqual((pool.matches, pool.eloSum, pool.waitingPlayers()),
+                self.bruteForceWidening(events, thresh, widenBy, widenEvery))
+
+
+    def writeLog(self, thresh, events):
+        #the events as an input file, the way main reads them
+        path = os.path.join(self.workDir, 'events.txt')
+        with open(path, 'w') as log:
+            log.write("%d %d\n" % (thresh, len(events)))
+            for logon, playerID, playerElo in events:
+                if logon:
+                    log.write("logon %d %d\n" % (playerID, playerElo))
+                else:
+                    log.write("logoff %d\n" % playerID)
+        return path
+
+    @staticmethod
+    def replayLog(pool, logPath, numEvents, offset=None):
+        """
+        replay numEvents events of the log through pool, from the start or
+        from byte offset, and return the reader left after them
+        """
+        reader = TokenReader(logPath)
+        if offset is None:
+            reader.ints(2)
+        else:
+            reader.seek(offset)
+        replay(pool, readEvents(reader, numEvents))
+        return reader
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workDir)
+
+    def test_CheckpointResume(self):
+        rng = random.Random(19)
+        checkpointPath = os.path.join(self.workDir, 'pool.ckpt')
+        setups = [(engine, {}) for engine in sorted(POOL_ENGINES)]
+        setups.append(('party', {'partySize': 3}))
+        setups.append(('widening', {'widenBy': 2, 'widenEvery': 7}))
+        for n in xrange(6):
+            thresh = rng.choice([0, 4, 15])
+            events = self.randomStream(rng, 600, rng.choice([20, 300]), -30, 120)
+            logPath = self.writeLog(thresh, events)
+            for engine, options in setups:
+                full = POOL_ENGINES[engine](thresh, **options)
+                self.replayLog(full, logPath, len(events))
+
+                half = len(events) // 2
+                pool = POOL_ENGINES[engine](thresh, **options)
+                reader = self.replayLog(pool, logPath, half)
+                saveCheckpoint(pool, checkpointPath, half, reader.tell())
+
+                resumed, eventIndex, offset = loadCheckpoint(checkpointPath, engine, **options)
+                self.assertEqual(eventIndex, half)
+                self.assertEqual(resumed.eloThresh, thresh)
+                self.replayLog(resumed, logPath, len(events) - half, offset)
+                self.assertSamePools(resumed, full)
+
+    def test_CheckpointVersion1(self):
+        #a version 1 file: the header without metaSize, then ids and Elos
+        rng = random.Random(1)
+        events = self.randomStream(rng, 400, 200, 0, 300)
+        logPath = self.writeLog(10, events)
+        checkpointPath = os.path.join(self.workDir, 'pool.ckpt')
+        full = MatchMakingPool(10)
+        self.replayLog(full, logPath, len(events))
+
+        pool = MatchMakingPool(10)
+        reader = self.replayLog(pool, logPath, 200)
+        players = pool.waitingPlayers()
+        with open(checkpointPath, 'wb') as checkpoint:
+            checkpoint.write(CHECKPOINT_HEADER_V1.pack(CHECKPOINT_MAGIC, 1, 10,
+                pool.matches, pool.eloSum, 200, reader.tell(), len(players)))
+            for run in zip(*players):
+                checkpoint.write(buffer((ctypes.c_int64 * len(run))(*run)))
+
+        for engine in ('list', 'blocked', 'bucket', 'lazy', 'array'):
+            resumed, eventIndex, offset = loadCheckpoint(checkpointPath, engine)
+            self.replayLog(resumed, logPath, len(events) - eventIndex, offset)
+            self.assertSamePools(resumed, full)
+
+    def test_CheckpointParameters(self):
+        checkpointPath = os.path.join(self.workDir, 'pool.ckpt')
+        pool = PartyMatchMakingPool(5, partySize=3)
+        pool.newLogon(1, 100)
+        saveCheckpoint(pool, checkpointPath)
+        self.assertRaises(ValueError, loadCheckpoint, checkpointPath, 'party', partySize=4)
+        self.assertRaises(ValueError, loadCheckpoint, checkpointPath, 'list')
+        resumed = loadCheckpoint(checkpointPath, 'party', partySize=3)[0]
+        self.assertEqual(resumed.waitingPlayers(), [(1, 100)])
+
 
 if __name__ == '__main__':
 
@@ -206,22 +1640,130 @@ if __name__ == '__main__':
                 who is logging in.  Sorted list lets you focus on the two
                 nearest players instead of having to search all n players
                 for teh closest.
+                BlockedMatchMakingPool (--engine blocked) does the dict plus
+                sorted structure version of this.
 
     """
 
-    eloThresh, num_events = sys.stdin.readline().split()
+    reader = TokenReader(sys.stdin)
+    eloThresh, num_events = reader.ints(2)
+
+    #instantiate the pool object, --engine NAME picks one of POOL_ENGINES,
+    #--dead-ratio R tunes the lazy engine's compaction, --party-size N
+    #switches to the party engine with N player lobbies, --widen-by W
+    #[--widen-every E] to the widening engine, --time reports how long the
+    #events took on stderr and --stats dumps the pool's stats()
+    args = sys.argv[1:]
+    engine = None
+    if '--engine' in args:
+        engine = args[args.index('--engine') + 1]
+    options = {}
+    flags = {}
+    if '--dead-ratio' in args:
+        options['deadRatio'] = float(args[args.index('--dead-ratio') + 1])
+        flags['deadRatio'] = '--dead-ratio'
+    if '--party-size' in args:
+        #lobbies of N players, picks the party engine
+        engine = engine or 'party'
+        options['partySize'] = int(args[args.index('--party-size') + 1])
+        flags['partySize'] = '--party-size'
+    if '--widen-by' in args:
+        #thresholds grow by W every E events waited, picks the widening engine
+        engine = engine or 'widening'
+        options['widenBy'] = int(args[args.index('--widen-by') + 1])
+        flags['widenBy'] = '--widen-by'
+    if '--widen-every' in args:
+        options['widenEvery'] = int(args[args.index('--widen-every') + 1])
+        flags['widenEvery'] = '--widen-every'
+    engine = engine or 'list'
+    if not engine in POOL_ENGINES:
+        sys.exit("unknown engine %s, pick one of %s" % (
+            engine, ", ".join(sorted(POOL_ENGINES))))
+    for name in sorted(options):
+        if not name in ENGINE_OPTIONS.get(engine, ()):
+            sys.exit("%s does not apply to the %s engine" % (flags[name], engine))
 
-    #instantiate the pool object
-    myPool = MatchMakingPool(eloThresh)
+    if '--thresholds' in args:
+        #what-if mode: --thresholds T1,T2,... replays the log once per
+        #threshold (the one in the file is ignored), --workers N spreads
+        #the replays over N processes
+        thresholds = [int(t) for t in
+            args[args.index('--thresholds') + 1].split(',')]
+        workers = 1
+        if '--workers' in args:
+            workers = int(args[args.index('--workers') + 1])
+        events = readEvents(reader, num_events)
+        print "threshold matches eloSum pool"
+        for row in replayThresholds(events, thresholds, engine, workers, options):
+            print " ".join(str(value) for value in row)
+        sys.exit(0)
 
-    for i in range(int(num_events)):
-        playerInfo = sys.stdin.readline().strip()
-        splitline = playerInfo.split(" ")
-        playerAction = splitline[0].lower()
-        playerID = int(splitline[1])
+    if '--sharded' in args:
+        #queue keyed events, one pool per queue spread over --workers N
+        #processes (default: all cores).  --per-queue prints every queue's
+        #"queue matches eloSum pool" before the merged totals
+        workers = None
+        if '--workers' in args:
+            workers = int(args[args.index('--workers') + 1])
+        start = time.time()
+        try:
+            totals = runSharded(reader, num_events, eloThresh, engine, workers,
+                options=options)
+        except RuntimeError as error:
+            sys.exit(str(error))
+        if '--per-queue' in args:
+            for queue in sorted(totals):
+                print queue, " ".join(str(value) for value in totals[queue])
+        print " ".join(str(sum(row[col] for row in totals.itervalues()))
+            for col in xrange(3))
+        if '--time' in args:
+            elapsed = time.time() - start
+            sys.stderr.write("sharded: %d events in %.3fs (%.0f events/sec)\n" % (
+                num_events, elapsed, num_events / max(elapsed, 1e-9)))
+        sys.exit(0)
+
+    #--resume FILE continues from a checkpoint instead of the first event,
+    #--checkpoint FILE saves one at the end, and every N events as well
+    #with --checkpoint-every N
+    firstEvent = 0
+    if '--resume' in args:
+        try:
+            myPool, firstEvent, offset = loadCheckpoint(
+                args[args.index('--resume') + 1], engine, **options)
+        except ValueError as error:
+            sys.exit(str(error))
+        if myPool.eloThresh != eloThresh:
+            sys.exit("the checkpoint was taken with eloThresh %d, not %d" % (
+                myPool.eloThresh, eloThresh))
+        reader.seek(offset)
+    else:
+        myPool = POOL_ENGINES[engine](eloThresh, **options)
+    checkpointPath = None
+    if '--checkpoint' in args:
+        checkpointPath = args[args.index('--checkpoint') + 1]
+    nextCheckpoint = None
+    if checkpointPath and '--checkpoint-every' in args:
+        checkpointEvery = int(args[args.index('--checkpoint-every') + 1])
+        nextCheckpoint = firstEvent + checkpointEvery
+    if '--instrument' in args:
+        #--instrument FILE ('-' for stderr) writes PoolInstrumentation's
+        #report at exit, and whenever the process gets SIGUSR1
+        instrumentPath = args[args.index('--instrument') + 1]
+        instrumentation = PoolInstrumentation()
+        instrumentation.attach(myPool)
+        atexit.register(instrumentation.dump, instrumentPath)
+        signal.signal(signal.SIGUSR1,
+            lambda signum, frame: instrumentation.dump(instrumentPath))
+    start = time.time()
+
+    for i in xrange(firstEvent, num_events):
+        #every event is "logon id elo" or "logoff id", so the action
+        #token tells us how many numbers follow it
+        playerAction = reader.next_token().lower()
+        playerID = reader.next_int()
 
         if(playerAction=="logon"):
-            playerElo = int(splitline[2])
+            playerElo = reader.next_int()
             #logon the player
             myPool.newLogon(playerID, playerElo)
 
@@ -230,6 +1772,20 @@ if __name__ == '__main__':
             #and eliminate the player
             myPool.newLogoff(playerID)
 
+        if i + 1 == nextCheckpoint:
+            saveCheckpoint(myPool, checkpointPath, i + 1, reader.tell())
+            nextCheckpoint += checkpointEvery
+
+    if checkpointPath:
+        saveCheckpoint(myPool, checkpointPath, num_events, reader.tell())
+
+    if '--time' in args:
+        elapsed = time.time() - start
+        sys.stderr.write("%s: %d events in %.3fs (%.0f events/sec)\n" % (
+            engine, num_events - firstEvent, elapsed,
+            (num_events - firstEvent) / max(elapsed, 1e-9)))
+    if '--stats' in args and hasattr(myPool, 'stats'):
+        sys.stderr.write(json.dumps(myPool.stats(), sort_keys=True) + "\n")
 
     #outside the loop, print the final results
-    print str(myPool.matches) + " " + str(myPool.eloSum) + " " + str(len(myPool.idList))
+    print str(myPool.matches) + " " + str(myPool.eloSum) + " " + str(myPool.poolSize())
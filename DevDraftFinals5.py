@@ -1,85 +1,241 @@
 #pylint: disable=all
+import os
+import re
 import sys
+import json
+import signal
+import tempfile
+import atexit
+import bisect
 import unittest
+from array import array
+from collections import OrderedDict
+from fastinput import TokenReader
+
+
+class AddressRecord(object):
+    """
+    One address line split into its fields, once.  line2 is None when the
+    address has a single street line, zipCode is None when there is no
+    5 digit run in the last field, and any field the line is too short to
+    have is None as well.
+    """
+    __slots__ = ('street', 'line2', 'city', 'state', 'zipCode')
+
+    _zip = re.compile(r'[0-9]{5}')
+
+    def __init__(self, addressLine):
+        splitline = addressLine.split(",")
+        #take everything before the first comma
+        ###devdraft: the street address could extend through to the second
+        ###         comma if the address has a second line, that line is
+        ###         kept separately in line2
+        self.street = splitline[0].strip()
+
+        #length of 3 implies no second address line, otherwise the city and
+        #the state are one field further along
+        ###devdraft: the original code assumed a single street line, so with
+        ###         a second line it returned that line as the city, and the
+        ###         city as the state.  The field count tells the two cases
+        ###         apart: city is [1] and state [2] for 3 fields, [2] and
+        ###         [3] otherwise
+        if len(splitline) == 3:
+            self.line2 = None
+            cityField = 1
+        else:
+            self.line2 = splitline[1].strip() if len(splitline) > 1 else None
+            cityField = 2
+        self.city = None
+        self.state = None
+        if len(splitline) > cityField:
+            self.city = splitline[cityField].strip()
+        if len(splitline) > cityField + 1:
+            self.state = splitline[cityField + 1].strip().split(" ")[0].strip()
+
+        #the zip is the first 5 digits in a row in the last field
+        ###devdraft: the original scanned the whole line, so a street number
+        ###         of 5 or more digits was taken as the zip.  The addresses
+        ###         are normalized, so the zip is always in the last field and
+        ###         that is the only place searched.  No 5 digits there gives
+        ###         None rather than a zip of 0, which would be a valid (but
+        ###         wrong) shipping band
+        match = self._zip.search(splitline[-1])
+        self.zipCode = int(match.group()) if match is not None else None
+
+
+class AddressCache(object):
+    """
+    Bounded LRU cache of AddressRecords keyed by the raw address line, so an
+    address that shows up again is not parsed again.  Once maxSize lines are
+    cached, the least recently used one makes room for the next.
+    """
+
+    def __init__(self, maxSize=65536):
+        self.maxSize = maxSize
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, addressLine):
+        record = self.records.pop(addressLine, None)
+        if record is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            record = AddressRecord(addressLine)
+            if len(self.records) >= self.maxSize:
+                self.records.popitem(last=False)
+                self.evictions += 1
+        #(re)inserting makes it the most recently used
+        self.records[addressLine] = record
+        return record
+
+    def stats(self):
+        return {
+            'size': len(self.records),
+            'maxSize': self.maxSize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
 
 
 class Address:
 
+    #every Address shares this cache, replace it to change the size
+    cache = AddressCache()
+
     def __init__(self, addressLine):
         self.addressLine = addressLine
+        ###devdraft: every getter used to split the whole line again, so the
+        ###         line is parsed once into a record (or found in the cache)
+        self.record = Address.cache.lookup(addressLine)
 
     def getStreetAddress(self):
-        #take everything before the first comma
-        ###devdraft: documentation states that the street address could
-        ###         possibly extend through to the second comma if the
-        ###         address contains a second line, so we need to check
-        ###         which case, and send back info up to the second comma
-        ###         if there are two address lines
-        return self.addressLine.split(",")[0].strip()
+        #everything before the first comma
+        return self.record.street
+
+    def getSecondLine(self):
+        #the second street line, None if there is none
+        return self.record.line2
 
     def getCityName(self):
         #the city appears after the first (OR SECOND) comma
-        ###devdraft: Since the specification explains that the address
-        ###         could have a second address line, separated by a commma
-        ###         from the street number and street name, we should not
-        ###         assume that the city name will be contained in item [1]
-        ###     There are really 2 cases here.  One where the second line st
-        ###         address is specified, and one where it is not.  If the
-        ###         former is true, we should look at [2] instead of [1],
-        ###         otherwise look at [1].  This can be determined by length
-        ###         of string after a split
-        splitline = self.addressLine.split(",")
-        #length of 3 implies no second address line
-        if len(splitline) == 3:
-            return splitline[1].strip()
-        else:
-            return splitline[2].strip()
+        return self.record.city
 
     def getState(self):
         #state appears after 2 (OR 3) commas
-        ###devdraft: again, if the street address takes up two lines, the
-        ###         stateline could occur at [3] instead of [2]
-        splitline = self.addressLine.split(",")
-        if len(splitline) == 3:
-            stateLine = splitline[2].strip()
-        else:
-            stateLine = splitline[3].strip()
-        return stateLine.split(" ")[0].strip()
+        return self.record.state
 
     def getZipCode(self):
-        consecutiveDigits = 0
-
-        #search for something that matches 5 consecutive digits
-        ###devdraft: what if the street address has 5 digits?
-        ###         we can safely assume based on the normalized
-        ###         addresses that we will only have zip codes at the very
-        ###         end of the text, which after a split, could be
-        ###         obtained by using "len(splitline)-1".  So we only
-        ###         need to search that location.  Also assuming that
-        ###         state field will not be a series of digits
-        splitline = self.addressLine.split(",")
-        correctline = splitline[len(splitline)-1]
-        for i in range (len(correctline)):
-            c = correctline[i]
-            if c.isdigit():
-                consecutiveDigits+=1
-                if consecutiveDigits == 5:
-                    return int(correctline[i-4: i+1])
-            else:
-                consecutiveDigits = 0;
-
-        #should never happen
-        ###devdraft: but what if it does? maybe we should return
-        ###         an error, or "None", since a zip of 0 would
-        ###         actually result in a valid (but incorrect)
-        ###         shipping calculation
-        return None
+        #first 5 consecutive digits of the last field, None if there are none
+        return self.record.zipCode
+
+
+class PricingRules(object):
+    """
+    Tax and shipping rules compiled into lookup tables.  A config is a dict
+    (or a JSON file, see load) like DEFAULT_CONFIG:
+        defaultRate   tax percent for any state not listed
+        stateRates    state name -> tax percent, any capitalization
+        overrides     more state -> percent entries that win over stateRates
+        baseShipping  cost for zips below the first band
+        zipBands      [first zip of the band, cost] pairs
+    The states become one dict (a single lookup per order however many
+    there are) and the bands become a sorted list of band starts for
+    bisect, so both lookups stay flat as the rules grow.
+    PricingRules.active is the table set the calculators use unless they
+    are handed one.  install replaces it with a single assignment, and the
+    main loop and priceOrders read it once per order (or batch) and hand
+    it to both the tax and the shipping calculation, so a reload never
+    mixes old and new rules in one result.
+    """
+
+    DEFAULT_CONFIG = {
+        "defaultRate": 7,
+        "stateRates": {"arizona": 5, "washington": 9, "california": 6, "delaware": 0},
+        "overrides": {},
+        "baseShipping": 30,
+        #zip codes above 75000 ship for 10, 25000 through 75000 for 20
+        "zipBands": [[25000, 20], [75001, 10]],
+    }
+
+    def __init__(self, config):
+        def integer(value, what):
+            #tax is integer math, a float rate would change the results
+            if not isinstance(value, (int, long)) or isinstance(value, bool):
+                raise ValueError("%s must be an integer, not %r" % (what, value))
+            return int(value)
+
+        self.defaultRate = integer(config.get("defaultRate", 0), "defaultRate")
+        self.stateRates = {}
+        for section in ("stateRates", "overrides"):
+            for state, rate in config.get(section, {}).iteritems():
+                self.stateRates[str(state).lower()] = integer(rate, "rate of %s" % state)
+
+        bands = sorted((integer(start, "band start"), integer(cost, "band cost"))
+            for start, cost in config.get("zipBands", []))
+        for i in xrange(1, len(bands)):
+            if bands[i][0] == bands[i-1][0]:
+                raise ValueError("two shipping bands start at zip %d" % bands[i][0])
+        #costs[i] is the cost below zipStarts[i], costs[-1] above the last start
+        self.zipStarts = [start for start, cost in bands]
+        self.costs = [integer(config.get("baseShipping", 0), "baseShipping")] + \
+            [cost for start, cost in bands]
+
+    def taxRate(self, state):
+        return self.stateRates.get(state.lower(), self.defaultRate)
+
+    def shippingCost(self, zipCode):
+        return self.costs[bisect.bisect_right(self.zipStarts, zipCode)]
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as configFile:
+            return cls(json.load(configFile))
+
+    @classmethod
+    def install(cls, rules):
+        cls.active = rules
+
+
+PricingRules.active = PricingRules(PricingRules.DEFAULT_CONFIG)
+
+
+class RulesFile(object):
+    """
+    A rules config on disk that can be reloaded while orders are priced.
+    reloadIfChanged compiles the file again when its mtime moved and
+    installs the new tables.  A file that fails to load or compile raises
+    and leaves the rules that were active in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.reloads = 0
+
+    def reloadIfChanged(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return False
+        rules = PricingRules.load(self.path)
+        PricingRules.install(rules)
+        self.mtime = mtime
+        self.reloads += 1
+        return True
+
+
+#array typecodes whose items come back as int, 'I' and 'L' give longs on
+#Python 2, which the calculators reject like any other non int
+INT_TYPECODES = 'bBhHil'
 
 
 class TaxCalculator:
 
     @staticmethod
-    def calculateTax(orderAmount, state):
+    def calculateTax(orderAmount, state, rules=None):
         ###devdraft: adjust for four possibilities:
         ###     1) the state might not be capitalized
         ###     2) the state could be "None" if the parsing fails
@@ -87,38 +243,73 @@ class TaxCalculator:
         ###     4) orderAmount might not be an int (and we try to / with it)
         ###     should handle these cases gracefully
         if state is not None and orderAmount is not None and isinstance(orderAmount, int):
-            state = state.lower()
-            if state == "arizona":
-                return orderAmount / 100 * 5
-            elif state == "washington":
-                return orderAmount / 100 * 9
-            elif state == "california":
-                return orderAmount / 100 * 6
-            elif state == "delaware":
-                return 0
-            else:
-                return orderAmount / 100 * 7
+            return orderAmount / 100 * (rules or PricingRules.active).taxRate(state)
         else: return None
 
+    @staticmethod
+    def calculateTaxes(orderAmounts, states, rules=None):
+        """
+        calculateTax for whole columns of order amounts and states, returns
+        a list, with the same integer orderAmount / 100 * rate and the same
+        None results.  The whole batch is priced with one set of rules,
+        the active ones unless rules is given.
+        """
+        rules = rules or PricingRules.active
+        rateOf = rules.stateRates.get
+        default = rules.defaultRate
+        rates = [None if state is None else rateOf(state.lower(), default)
+            for state in states]
+        if isinstance(orderAmounts, array) and orderAmounts.typecode in INT_TYPECODES:
+            #every amount is an int already
+            return [None if state is None else amount / 100 * rate
+                for amount, state, rate in zip(orderAmounts, states, rates)]
+        return [amount / 100 * rate
+            if state is not None and amount is not None and isinstance(amount, int)
+            else None
+            for amount, state, rate in zip(orderAmounts, states, rates)]
+
 
 class ShippingCalculator:
 
     @staticmethod
-    def calculateShipping(zipCode):
+    def calculateShipping(zipCode, rules=None):
         ###devdraft: description says "zip codes higher than 75,000", but
         ###         the first condition checked >=, not >, so a zip code of
         ###         exactly 75,000 would return 10 when it should return 20
         ###     also need to make sure that zipcode is a number (not None)
         if zipCode is not None and isinstance(zipCode, int):
-            if zipCode > 75000:
-                return 10
-            elif zipCode >= 25000:
-                return 20
-            else:
-                return 30
+            return (rules or PricingRules.active).shippingCost(zipCode)
         else:
             return None
 
+    @staticmethod
+    def calculateShippings(zipCodes, rules=None):
+        """
+        calculateShipping for a whole column of zip codes, returns a list.
+        Each zip is one bisect into the band starts.
+        """
+        rules = rules or PricingRules.active
+        bounds = rules.zipStarts
+        costs = rules.costs
+        if isinstance(zipCodes, array) and zipCodes.typecode in INT_TYPECODES:
+            return [costs[bisect.bisect_right(bounds, zipCode)] for zipCode in zipCodes]
+        return [costs[bisect.bisect_right(bounds, zipCode)]
+            if zipCode is not None and isinstance(zipCode, int) else None
+            for zipCode in zipCodes]
+
+
+def priceOrders(basePrices, states, zipCodes):
+    """
+    Price a batch of orders given as columns, the same as the main loop does
+    one order at a time: base price plus tax plus shipping.  An order whose
+    tax or shipping is None comes out as None.
+    """
+    rules = PricingRules.active
+    taxes = TaxCalculator.calculateTaxes(basePrices, states, rules)
+    shippings = ShippingCalculator.calculateShippings(zipCodes, rules)
+    return [None if tax is None or shipping is None else basePrice + tax + shipping
+        for basePrice, tax, shipping in zip(basePrices, taxes, shippings)]
+
 
 class UnitTests(unittest.TestCase):
 
@@ -189,19 +380,153 @@ class UnitTests(unittest.TestCase):
         self.assertNotEqual(myaddr.getZipCode(), 76543)
         self.assertEqual(myaddr.getZipCode(), 90210)
 
+    def test_AddressRecord(self):
+        record = AddressRecord("add line 1, add line 2, mycity, mystate 12345")
+        self.assertEqual((record.street, record.line2, record.city, record.state,
+            record.zipCode), ("add line 1", "add line 2", "mycity", "mystate", 12345))
+        record = AddressRecord("add line 1, mycity, mystate nozip")
+        self.assertEqual((record.street, record.line2, record.city, record.state,
+            record.zipCode), ("add line 1", None, "mycity", "mystate", None))
+        self.assertEqual(AddressRecord("12345 lonely street").zipCode, 12345)
+        self.assertIsNone(AddressRecord("lonely street, 12345").state)
+
+    def test_AddressCache(self):
+        cache = AddressCache(2)
+        first = cache.lookup("a, b, c 12345")
+        self.assertIs(cache.lookup("a, b, c 12345"), first)
+        cache.lookup("d, e, f 54321")
+        cache.lookup("a, b, c 12345")
+        #"d, e, f 54321" is now the least recently used
+        cache.lookup("g, h, i 11111")
+        self.assertEqual(list(cache.records), ["a, b, c 12345", "g, h, i 11111"])
+        self.assertEqual(cache.stats(), {'size': 2, 'maxSize': 2, 'hits': 2,
+            'misses': 3, 'evictions': 1})
+
+    def test_RulesMatchBuiltin(self):
+        #the default config is the original hard coded rules
+        for state, rate in {"Arizona": 5, "washington": 9, "CALIFORNIA": 6,
+                "Delaware": 0, "Kentucky": 7}.iteritems():
+            self.assertEqual(TaxCalculator.calculateTax(1234, state), 1234 / 100 * rate)
+        rules = PricingRules(PricingRules.DEFAULT_CONFIG)
+        for zipCode, cost in {0: 30, 24999: 30, 25000: 20, 75000: 20, 75001: 10}.iteritems():
+            self.assertEqual(rules.shippingCost(zipCode), cost)
+
+    def test_RulesConfig(self):
+        rules = PricingRules({"defaultRate": 4, "stateRates": {"Ohio": 6, "Utah": 5},
+            "overrides": {"UTAH": 1}, "baseShipping": 50,
+            "zipBands": [[90000, 5], [10000, 40], [50000, 20]]})
+        self.assertEqual([rules.taxRate(s) for s in ("ohio", "Utah", "Maine")], [6, 1, 4])
+        self.assertEqual([rules.shippingCost(z) for z in (9999, 10000, 50000, 89999, 90000)],
+            [50, 40, 20, 20, 5])
+        self.assertRaises(ValueError, PricingRules, {"stateRates": {"Ohio": 5.5}})
+        self.assertRaises(ValueError, PricingRules, {"zipBands": [[1, 2], [1, 3]]})
+
+    def test_RulesReload(self):
+        active = PricingRules.active
+        handle, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(handle, "w") as config:
+                json.dump({"defaultRate": 10, "baseShipping": 1}, config)
+            rulesFile = RulesFile(path)
+            self.assertTrue(rulesFile.reloadIfChanged())
+            self.assertFalse(rulesFile.reloadIfChanged())
+            self.assertEqual(TaxCalculator.calculateTax(500, "Arizona"), 50)
+            self.assertEqual(ShippingCalculator.calculateShipping(99999), 1)
+
+            #a broken file keeps the rules that were loaded
+            with open(path, "w") as config:
+                config.write("{not json")
+            os.utime(path, (0, 0))
+            self.assertRaises(ValueError, rulesFile.reloadIfChanged)
+            self.assertEqual(TaxCalculator.calculateTax(500, "Arizona"), 50)
+        finally:
+            os.remove(path)
+            PricingRules.install(active)
+
+    def test_RulesPassedIn(self):
+        #rules handed to a calculation win over the active ones
+        rules = PricingRules({"defaultRate": 10, "baseShipping": 1})
+        self.assertEqual(TaxCalculator.calculateTax(500, "Arizona", rules), 50)
+        self.assertEqual(ShippingCalculator.calculateShipping(99999, rules), 1)
+        self.assertEqual(TaxCalculator.calculateTax(500, "Arizona"), 25)
+        self.assertEqual(ShippingCalculator.calculateShipping(99999), 10)
+
+    def test_BatchMatchesScalar(self):
+        amounts = [0, 1, 99, 100, 150, 12345, -250, None, "i'm a string!", 10**6]
+        states = ["Arizona", "washington", "CALIFORNIA", "Delaware", "Kentucky",
+            "New HampShire", None, "arizona", "delaware", "california"]
+        zips = [0, 24999, 25000, 74999, 75000, 75001, 123456, None, "not an int", -5]
+        for shift in xrange(len(states)):
+            rotated = states[shift:] + states[:shift]
+            self.assertEqual(TaxCalculator.calculateTaxes(amounts, rotated),
+                [TaxCalculator.calculateTax(a, s) for a, s in zip(amounts, rotated)])
+        self.assertEqual(ShippingCalculator.calculateShippings(zips),
+            [ShippingCalculator.calculateShipping(z) for z in zips])
+
+        ints = array('l', [a for a in amounts if isinstance(a, int)])
+        someStates = states[:len(ints)]
+        self.assertEqual(TaxCalculator.calculateTaxes(ints, someStates),
+            [TaxCalculator.calculateTax(a, s) for a, s in zip(ints, someStates)])
+        intZips = array('l', [z for z in zips if isinstance(z, int)])
+        self.assertEqual(ShippingCalculator.calculateShippings(intZips),
+            [ShippingCalculator.calculateShipping(z) for z in intZips])
+        #'I' items are longs, so they go through the checks and give None
+        self.assertEqual(TaxCalculator.calculateTaxes(array('I', [500, 1000]),
+            ["arizona", "ohio"]), [TaxCalculator.calculateTax(long(a), "ohio") for a in (500, 1000)])
+        self.assertEqual(ShippingCalculator.calculateShippings(array('I', [80000])),
+            [ShippingCalculator.calculateShipping(80000L)])
+        self.assertEqual(priceOrders(array('l', [100, 200]), ["arizona", None], [80000, 1]),
+            [100 + 5 + 10, None])
+
 
 #main
 if __name__ == '__main__':
     #unittest.main()
 
-    numTestCases = int(sys.stdin.readline().strip())
+    reader = TokenReader(sys.stdin)
+    numTestCases = reader.line_ints()[0]
+
+    if '--cache-stats' in sys.argv[1:]:
+        #report how well the address cache did on stderr at exit
+        atexit.register(lambda: sys.stderr.write(
+            "address cache: %(hits)d hits, %(misses)d misses, "
+            "%(evictions)d evictions\n" % Address.cache.stats()))
+
+    if '--rules' in sys.argv[1:]:
+        #--rules FILE prices with the rules in FILE instead of the built in
+        #ones, and reloads it whenever the process gets SIGHUP
+        rulesFile = RulesFile(sys.argv[sys.argv.index('--rules') + 1])
+        rulesFile.reloadIfChanged()
+        def reloadRules(signum, frame):
+            try:
+                rulesFile.reloadIfChanged()
+            except (IOError, OSError, ValueError) as error:
+                sys.stderr.write("keeping the old rules: %s\n" % error)
+        signal.signal(signal.SIGHUP, reloadRules)
+
+    if '--batch' in sys.argv[1:]:
+        #read every order into columns, then price them all at once
+        basePrices = array('l')
+        states = []
+        zipCodes = []
+        for i in range(numTestCases):
+            basePrices.append(reader.line_ints()[0])
+            addr = Address(reader.line())
+            states.append(addr.getState())
+            zipCodes.append(addr.getZipCode())
+        sys.stdout.write("".join("%s\n" % total
+            for total in priceOrders(basePrices, states, zipCodes)))
+        sys.exit(0)
 
     for i in range(numTestCases):
-        basePrice = int(sys.stdin.readline().strip())
-        addressString = sys.stdin.readline().strip()
+        basePrice = reader.line_ints()[0]
+        addressString = reader.line()
         addr = Address(addressString)
 
-        taxAmount = TaxCalculator.calculateTax(basePrice, addr.getState())
-        shippingAmount = ShippingCalculator.calculateShipping(addr.getZipCode())
+        #one set of rules for the whole order, a SIGHUP reload can land
+        #between the two calculations
+        rules = PricingRules.active
+        taxAmount = TaxCalculator.calculateTax(basePrice, addr.getState(), rules)
+        shippingAmount = ShippingCalculator.calculateShipping(addr.getZipCode(), rules)
 
         print (basePrice + taxAmount + shippingAmount)
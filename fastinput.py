@@ -0,0 +1,194 @@
+# pylint: disable=all
+import mmap
+import os
+import re
+import sys
+
+
+class TokenReader(object):
+	"""
+	A TokenReader pulls whitespace separated tokens out of stdin or a file
+	without going through readline.  Regular files are memory mapped, so the
+	whole input is visible at once and nothing gets copied up front.  Pipes
+	(like stdin redirected from another program) are read in large chunks,
+	and a token that gets cut off at the end of a chunk is carried over to
+	the next one.
+	Tokens are matched straight out of the buffer, so there is never a
+	Python string made for a whole line, only for the tokens themselves.
+	Two styles of reading are supported:
+		token stream: next_token, next_int, ints, tokens, int_stream
+			these ignore line breaks completely
+		line based: line_ints, line
+			these read up to the end of the current line, which is
+			needed when a line may carry extra values that must be skipped
+	"""
+
+	_token = re.compile(r'\S+')
+
+	def __init__(self, source=None, chunk_size=1 << 20):
+		if source is None:
+			source = sys.stdin
+		elif isinstance(source, basestring):
+			source = open(source, 'rb')
+
+		self._source = source
+		self._chunk_size = chunk_size
+		self._buf = ''
+		self._pos = 0
+		#byte offset of self._buf[0] in the whole input
+		self._base = 0
+		self._eof = False
+
+		#try to map the whole file, fall back to chunked reads for pipes
+		try:
+			fileno = source.fileno()
+			if os.fstat(fileno).st_size > 0 and source.tell() == 0:
+				self._buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+				self._eof = True
+		except (AttributeError, IOError, OSError, ValueError, mmap.error):
+			pass
+		if not self._eof:
+			#a file that was already partly read starts counting from there
+			try:
+				self._base = source.tell()
+			except (AttributeError, IOError):
+				pass
+
+
+	def _refill(self):
+		"""
+		Drop everything that has already been consumed and append the next
+		chunk of input.  Returns False once the input is exhausted.
+		"""
+		if self._eof:
+			return False
+		chunk = self._source.read(self._chunk_size)
+		if not chunk:
+			self._eof = True
+			return False
+		self._base += self._pos
+		self._buf = self._buf[self._pos:] + chunk
+		self._pos = 0
+		return True
+
+
+	def tell(self):
+		"""
+		byte offset of the next unread character in the input
+		"""
+		return self._base + self._pos
+
+
+	def seek(self, offset):
+		"""
+		Continue reading at byte offset, as returned by tell().  Mapped files
+		and seekable streams jump straight there, pipes can only be skipped
+		forward, which reads and drops everything up to offset.
+		"""
+		if isinstance(self._buf, mmap.mmap):
+			self._pos = offset
+			return
+		if self._base <= offset <= self._base + len(self._buf):
+			self._pos = offset - self._base
+			return
+		try:
+			self._source.seek(offset)
+		except (AttributeError, IOError):
+			if offset < self._base:
+				raise IOError("cannot seek backwards in a pipe")
+			while self._base + len(self._buf) < offset:
+				self._pos = len(self._buf)
+				if not self._refill():
+					return
+			self._pos = offset - self._base
+			return
+		self._buf = ''
+		self._pos = 0
+		self._base = offset
+		self._eof = False
+
+
+	def next_token(self):
+		"""
+		return the next token, or None at the end of the input
+		"""
+		while True:
+			match = self._token.search(self._buf, self._pos)
+			if match is None:
+				#only whitespace left in the buffer
+				self._pos = len(self._buf)
+				if not self._refill():
+					return None
+			elif match.end() == len(self._buf) and not self._eof:
+				#the token might continue in the next chunk
+				self._pos = match.start()
+				self._refill()
+			else:
+				self._pos = match.end()
+				return match.group()
+
+
+	def next_int(self):
+		return int(self.next_token())
+
+
+	def ints(self, count):
+		"""
+		return a list of the next count integers, line breaks are ignored
+		"""
+		next_token = self.next_token
+		return [int(next_token()) for i in xrange(count)]
+
+
+	def tokens(self):
+		"""
+		generator over all remaining tokens
+		"""
+		token = self.next_token()
+		while token is not None:
+			yield token
+			token = self.next_token()
+
+
+	def int_stream(self):
+		"""
+		generator over all remaining tokens as integers
+		"""
+		for token in self.tokens():
+			yield int(token)
+
+
+	def _line_end(self):
+		#find the end of the current line, pulling in more chunks if needed
+		end = self._buf.find('\n', self._pos)
+		while end < 0:
+			if not self._refill():
+				return len(self._buf)
+			end = self._buf.find('\n', self._pos)
+		return end
+
+
+	def line_ints(self):
+		"""
+		Return the integers on the rest of the current line and move on to
+		the next line, the same as map(int, readline().split()).
+		"""
+		end = self._line_end()
+		values = [int(match.group())
+			for match in self._token.finditer(self._buf, self._pos, end)]
+		self._pos = end + 1
+		return values
+
+
+	def line(self):
+		"""
+		Return the rest of the current line with surrounding whitespace
+		stripped, the same as readline().strip().  Returns None at the end of
+		the input.
+		"""
+		if self._pos >= len(self._buf) and not self._refill():
+			return None
+		end = self._line_end()
+		text = self._buf[self._pos:end].strip()
+		self._pos = end + 1
+		return text
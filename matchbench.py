@@ -0,0 +1,212 @@
+#pylint: disable=all
+"""
+Synthetic matchmaking workloads and a benchmark / equivalence harness for
+every pool in DevDraftFinals3.POOL_ENGINES.
+
+Usage:
+    matchbench.py gen KIND NUM_EVENTS ELOTHRESH [SEED] > stream.txt
+    matchbench.py bench FILE [ENGINE ...]
+
+gen writes a stream in the same format as p3ex*.txt.  KIND is one of
+    uniform    Elos spread evenly over 0..3000
+    clustered  most Elos packed around a few skill levels
+    churn      half of the events are logoffs, mostly of waiting players
+    burst      runs of logons that all share the same Elo
+The same KIND, NUM_EVENTS and SEED always give the same stream.
+
+bench runs each engine (all of them by default) in its own process, so
+peak memory is measured per engine.  The first engine is the reference:
+every other engine must end with the same matches, eloSum and waiting
+players, or it is reported as a mismatch.  Reported per engine: wall time,
+per event latency percentiles (from a histogram, within 5%) and how far
+the resident size peaked above what the parsed stream already took.
+"""
+
+import sys
+import time
+import json
+import random
+import hashlib
+import resource
+import subprocess
+from fastinput import TokenReader
+import DevDraftFinals3
+from matchservice import LatencyHistogram
+
+
+def generate(kind, numEvents, seed=1):
+    """
+    yield (action, playerID, playerElo) events, playerElo is None for logoffs
+    """
+    rng = random.Random(seed)
+    centers = [rng.randint(800, 2200) for c in xrange(5)]
+    nextID = 0
+    online = []
+    burstElo = None
+    burstLeft = 0
+
+    for i in xrange(numEvents):
+        logoffChance = 0.5 if kind == 'churn' else 0.1
+        if online and rng.random() < logoffChance:
+            if kind == 'churn' and rng.random() < 0.8:
+                #mostly players that are still (maybe) waiting
+                j = rng.randrange(len(online))
+                online[j], online[-1] = online[-1], online[j]
+                yield ('logoff', online.pop(), None)
+            else:
+                yield ('logoff', rng.randint(0, nextID), None)
+            continue
+
+        if kind == 'uniform' or kind == 'churn':
+            elo = rng.randint(0, 3000)
+        elif kind == 'clustered':
+            elo = int(rng.gauss(rng.choice(centers), 25))
+        elif kind == 'burst':
+            if burstLeft == 0:
+                burstElo = rng.randint(0, 3000)
+                burstLeft = rng.randint(1, 200)
+            burstLeft -= 1
+            elo = burstElo
+        else:
+            raise ValueError("unknown workload %r" % kind)
+
+        #remember a bounded sample of players for the logoffs to pick from
+        if len(online) < 100000:
+            online.append(nextID)
+        else:
+            online[rng.randrange(len(online))] = nextID
+        yield ('logon', nextID, elo)
+        nextID += 1
+
+
+def residentMB():
+    """
+    current resident set size in MB, from /proc on Linux, otherwise the
+    peak so far
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / 1048576.0
+    except IOError:
+        #ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def runEngine(engine, path, sampleEvery=4096):
+    """
+    Replay the stream in path through one engine and return its results.
+    Runs in a child process started by bench.
+    The stream is replayed twice on fresh pools.  The first pass has no
+    per event timing and samples the resident size every sampleEvery
+    events: peak MB is how far that got above the size right after
+    parsing, so it is the pool's memory and not the parsed events or the
+    harness.  The second pass times every event into a LatencyHistogram,
+    which is the same size however long the stream is.
+    """
+    reader = TokenReader(path)
+    eloThresh, numEvents = reader.ints(2)
+    logons, ids, elos = DevDraftFinals3.readEvents(reader, numEvents)
+
+    baseline = residentMB()
+    peak = baseline
+    pool = DevDraftFinals3.POOL_ENGINES[engine](eloThresh)
+    newLogon = pool.newLogon
+    newLogoff = pool.newLogoff
+    for i in xrange(len(ids)):
+        if logons[i]:
+            newLogon(ids[i], elos[i])
+        else:
+            newLogoff(ids[i])
+        if i % sampleEvery == 0:
+            peak = max(peak, residentMB())
+    peak = max(peak, residentMB())
+    del pool, newLogon, newLogoff
+
+    pool = DevDraftFinals3.POOL_ENGINES[engine](eloThresh)
+    newLogon = pool.newLogon
+    newLogoff = pool.newLogoff
+    timer = time.time
+    latencies = LatencyHistogram()
+    start = timer()
+    for i in xrange(len(ids)):
+        before = timer()
+        if logons[i]:
+            newLogon(ids[i], elos[i])
+        else:
+            newLogoff(ids[i])
+        latencies.add(timer() - before)
+    wall = timer() - start
+
+    def percentile(p):
+        latency = latencies.percentile(p)
+        return 0.0 if latency is None else latency * 1e6
+
+    waiting = hashlib.sha1(repr(list(pool.waitingPlayers()))).hexdigest()
+    return {
+        'engine': engine,
+        'events': numEvents,
+        'matches': pool.matches,
+        'eloSum': pool.eloSum,
+        'pool': pool.poolSize(),
+        'waiting': waiting,
+        'wallSeconds': wall,
+        'p50us': percentile(0.5),
+        'p99us': percentile(0.99),
+        'p999us': percentile(0.999),
+        'maxus': latencies.max * 1e6,
+        'peakRssMB': peak - baseline,
+    }
+
+
+def bench(path, engines):
+    results = []
+    for engine in engines:
+        output = subprocess.check_output(
+            [sys.executable, __file__, '_run', engine, path])
+        results.append(json.loads(output))
+
+    reference = results[0]
+    print "%-8s %10s %10s %10s %10s %10s %10s %10s  %s" % (
+        'engine', 'wall s', 'p50 us', 'p99 us', 'p99.9 us', 'max us',
+        'pool MB', 'matches', 'check')
+    failed = False
+    for result in results:
+        same = all(result[field] == reference[field]
+            for field in ('matches', 'eloSum', 'pool', 'waiting'))
+        failed = failed or not same
+        print "%-8s %10.3f %10.1f %10.1f %10.1f %10.1f %10.1f %10d  %s" % (
+            result['engine'], result['wallSeconds'], result['p50us'],
+            result['p99us'], result['p999us'], result['maxus'],
+            result['peakRssMB'], result['matches'],
+            'ok' if same else 'MISMATCH')
+    return not failed
+
+
+if __name__ == '__main__':
+
+    if sys.argv[1] == 'gen':
+        kind = sys.argv[2]
+        numEvents = int(sys.argv[3])
+        eloThresh = int(sys.argv[4])
+        seed = 1
+        if len(sys.argv) > 5:
+            seed = int(sys.argv[5])
+        out = sys.stdout
+        out.write("%d %d\n" % (eloThresh, numEvents))
+        for action, playerID, playerElo in generate(kind, numEvents, seed):
+            if playerElo is None:
+                out.write("%s %d\n" % (action, playerID))
+            else:
+                out.write("%s %d %d\n" % (action, playerID, playerElo))
+
+    elif sys.argv[1] == 'bench':
+        engines = sys.argv[3:]
+        if not engines:
+            #the original pool first, it is the reference
+            engines = ['list'] + sorted(engine for engine in
+                DevDraftFinals3.POOL_ENGINES if engine != 'list')
+        sys.exit(0 if bench(sys.argv[2], engines) else 1)
+
+    elif sys.argv[1] == '_run':
+        print json.dumps(runEngine(sys.argv[2], sys.argv[3]))
@@ -0,0 +1,298 @@
+#pylint: disable=all
+import sys
+import os
+import time
+import json
+import math
+import socket
+import asyncore
+import asynchat
+import random
+from array import array
+from DevDraftFinals3 import BlockedMatchMakingPool
+
+
+class LatencyHistogram(object):
+    """
+    Latencies counted into fixed, geometrically growing buckets, so a long
+    running process uses the same memory after a billion samples as after
+    one, and a percentile is a walk over the buckets instead of a sort.
+    Bucket i holds latencies up to SMALLEST * GROWTH ** i, which puts any
+    percentile within GROWTH of the true value.  Latencies past the last
+    bucket land in it, max is kept exactly.
+    """
+
+    SMALLEST = 1e-7
+    GROWTH = 1.05
+    BUCKETS = 450
+
+    def __init__(self):
+        self.counts = array('l', [0]) * self.BUCKETS
+        self.count = 0
+        self.max = 0.0
+        self._scale = 1.0 / math.log(self.GROWTH)
+
+    def add(self, seconds):
+        if seconds > self.SMALLEST:
+            bucket = int(math.ceil(math.log(seconds / self.SMALLEST) * self._scale))
+            self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        else:
+            self.counts[0] += 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """
+        latency in seconds that p of the samples are at or below, None if
+        there are no samples
+        """
+        if not self.count:
+            return None
+        #nearest rank: the smallest sample with at least p of them at or
+        #below it, the epsilon keeps 0.07 * 100 from rounding up to rank 8
+        rank = min(self.count, max(1, int(math.ceil(p * self.count - 1e-9))))
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.SMALLEST * self.GROWTH ** bucket, self.max)
+        return self.max
+
+
+class NotifyingPool(BlockedMatchMakingPool):
+    """
+    BlockedMatchMakingPool that remembers who got matched, so the service
+    can tell the clients.  lastMatch is (waiting player id, Elo difference)
+    of the most recent match.
+    """
+
+    def matchKey(self, key, eloDiff):
+        self.lastMatch = (self.playerIDs[key], eloDiff)
+        super(NotifyingPool, self).matchKey(key, eloDiff)
+
+
+class MatchClient(asynchat.async_chat):
+    """
+    One connected client.  Every line it sends is queued on the service
+    with its arrival time.  Lines use the same format as the batch input:
+    "logon id elo" or "logoff id".  "stats" asks for the service stats.
+    """
+
+    def __init__(self, sock, service):
+        asynchat.async_chat.__init__(self, sock)
+        self.service = service
+        self.buffer = []
+        self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.buffer).strip()
+        self.buffer = []
+        if line:
+            self.service.pending.append((time.time(), self, line))
+
+    def handle_close(self):
+        self.service.clients.discard(self)
+        self.close()
+
+
+class MatchService(asyncore.dispatcher):
+    """
+    A long running matchmaking service around one pool.  Clients connect
+    over TCP or a Unix socket and send events.  Events from every client
+    are applied in arrival order, in micro batches: the event loop runs
+    for at most batchInterval seconds, then everything that arrived is
+    applied at once.  Each match is pushed back as
+    "match <new player> <waiting player> <Elo difference>" to the clients
+    that logged those players on.
+    The service records the event-to-match latency of every match (from
+    the arrival of the logon that caused it to the notification being
+    queued) in a LatencyHistogram, and the number of events applied.  A
+    line that does not parse gets "error <line>: <reason>" back and is
+    not applied.
+    """
+
+    def __init__(self, address, thresh, batchInterval=0.005):
+        asyncore.dispatcher.__init__(self)
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+        self.address = self.socket.getsockname()
+
+        self.pool = NotifyingPool(thresh)
+        self.batchInterval = batchInterval
+        self.clients = set()
+        self.pending = []
+        #player id -> client that logged them on, for waiting players
+        self.owners = {}
+        self.latencies = LatencyHistogram()
+        self.events = 0
+        #arrival of the first applied event, eventsPerSec counts from here
+        self.firstEvent = None
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.clients.add(MatchClient(pair[0], self))
+
+    def applyPending(self):
+        """
+        apply every queued event, oldest first
+        """
+        batch = self.pending
+        self.pending = []
+        pool = self.pool
+        for arrived, client, line in batch:
+            try:
+                splitline = line.split()
+                playerAction = splitline[0].lower()
+                if playerAction == "logon":
+                    playerID = int(splitline[1])
+                    playerElo = int(splitline[2])
+                elif playerAction == "logoff":
+                    playerID = int(splitline[1])
+                elif playerAction != "stats":
+                    raise ValueError("unknown action")
+            except (IndexError, ValueError) as error:
+                #one bad line must not take the service down
+                if client.connected:
+                    client.push("error %s: %s\n" % (line, error))
+                continue
+
+            if playerAction == "logon":
+                matches = pool.matches
+                pool.newLogon(playerID, playerElo)
+                if pool.matches != matches:
+                    waitingID, eloDiff = pool.lastMatch
+                    self.notify(client, playerID, waitingID, eloDiff)
+                    self.latencies.add(time.time() - arrived)
+                else:
+                    self.owners[playerID] = client
+            elif playerAction == "logoff":
+                pool.newLogoff(playerID)
+                if not playerID in pool.playerKeys:
+                    self.owners.pop(playerID, None)
+            else:
+                client.push(json.dumps(self.stats(), sort_keys=True) + "\n")
+                continue
+            if self.firstEvent is None:
+                self.firstEvent = arrived
+            self.events += 1
+
+    def notify(self, client, playerID, waitingID, eloDiff):
+        message = "match %d %d %d\n" % (playerID, waitingID, eloDiff)
+        other = self.owners.pop(waitingID, None)
+        for target in set([client, other]):
+            if target is not None and target.connected:
+                target.push(message)
+
+    def stats(self):
+        elapsed = 0.0
+        if self.firstEvent is not None:
+            elapsed = time.time() - self.firstEvent
+        def milliseconds(p):
+            latency = self.latencies.percentile(p)
+            return None if latency is None else latency * 1000
+        return {
+            'events': self.events,
+            'matches': self.pool.matches,
+            'eloSum': self.pool.eloSum,
+            'pool': self.pool.poolSize(),
+            'eventsPerSec': self.events / max(elapsed, 1e-9),
+            'p50LatencyMs': milliseconds(0.5),
+            'p99LatencyMs': milliseconds(0.99),
+        }
+
+    def serveForever(self):
+        while True:
+            asyncore.loop(self.batchInterval, count=1)
+            if self.pending:
+                self.applyPending()
+
+
+def loadGenerator(address, numEvents, numClients=4, seed=1):
+    """
+    Connect numClients clients, send numEvents random events spread over
+    them as fast as possible, wait for the notifications to settle and
+    return the service stats.  Elos cluster around 1500 so that there are
+    plenty of matches.
+    """
+    rng = random.Random(seed)
+    family = socket.AF_UNIX if isinstance(address, basestring) else socket.AF_INET
+    clients = []
+    for c in xrange(numClients):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+        clients.append(sock)
+
+    start = time.time()
+    lines = [[] for c in xrange(numClients)]
+    for i in xrange(numEvents):
+        if rng.random() < 0.1:
+            lines[i % numClients].append("logoff %d\n" % rng.randint(0, i))
+        else:
+            lines[i % numClients].append("logon %d %d\n" % (i, int(rng.gauss(1500, 200))))
+    for sock, chunk in zip(clients, lines):
+        sock.sendall("".join(chunk))
+
+    #ask for stats until every event has been applied
+    stats = {}
+    while stats.get('events', 0) < numEvents:
+        clients[0].sendall("stats\n")
+        stats = _readStats(clients[0])
+    for sock in clients:
+        sock.close()
+    stats['loadgenSeconds'] = time.time() - start
+    return stats
+
+
+def _readStats(sock):
+    #skip match notifications until the stats line shows up
+    data = ""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return {}
+        data += chunk
+        lines = data.split("\n")
+        for line in lines[:-1]:
+            if line.startswith("{"):
+                return json.loads(line)
+        data = lines[-1]
+
+
+if __name__ == '__main__':
+
+    """
+    Usage:
+        matchservice.py serve ELOTHRESH (HOST:PORT | UNIXPATH) [BATCH_SECONDS]
+        matchservice.py loadgen (HOST:PORT | UNIXPATH) NUM_EVENTS [CLIENTS]
+    loadgen prints the service stats as JSON once all events are applied.
+    """
+
+    def parseAddress(text):
+        if ':' in text:
+            host, port = text.rsplit(':', 1)
+            return (host, int(port))
+        return text
+
+    if sys.argv[1] == 'serve':
+        batchInterval = 0.005
+        if len(sys.argv) > 4:
+            batchInterval = float(sys.argv[4])
+        service = MatchService(parseAddress(sys.argv[3]), int(sys.argv[2]), batchInterval)
+        service.serveForever()
+    elif sys.argv[1] == 'loadgen':
+        numClients = 4
+        if len(sys.argv) > 4:
+            numClients = int(sys.argv[4])
+        print json.dumps(loadGenerator(parseAddress(sys.argv[2]),
+            int(sys.argv[3]), numClients), sort_keys=True)
@@ -0,0 +1,66 @@
+#pylint: disable=all
+"""
+Micro-benchmark for the compiled pricing rules of DevDraftFinals5.
+
+Usage:
+    pricebench.py [LOOKUPS]
+
+For rule sets of growing size (N states and N shipping bands each) it
+times calculateTax and calculateShipping with those rules installed and
+prints the cost of one call in nanoseconds.  State lookups are a dict
+lookup and zip lookups a bisect, so the first column should not move and
+the second should only creep up with log N.
+"""
+
+import sys
+import time
+import random
+from DevDraftFinals5 import PricingRules, TaxCalculator, ShippingCalculator
+
+
+def makeConfig(numRules, seed=1):
+    rng = random.Random(seed)
+    return {
+        "defaultRate": 7,
+        "stateRates": dict(("state%d" % i, rng.randint(0, 12)) for i in xrange(numRules)),
+        "baseShipping": 30,
+        "zipBands": [[start, rng.randint(5, 40)]
+            for start in rng.sample(xrange(1, 100000), min(numRules, 99999))],
+    }
+
+
+def timeLookups(numRules, lookups):
+    """
+    (nanoseconds per calculateTax, nanoseconds per calculateShipping)
+    """
+    rng = random.Random(numRules)
+    states = ["State%d" % rng.randrange(numRules * 2) for i in xrange(lookups)]
+    zipCodes = [rng.randint(0, 99999) for i in xrange(lookups)]
+    active = PricingRules.active
+    PricingRules.install(PricingRules(makeConfig(numRules)))
+    try:
+        calculateTax = TaxCalculator.calculateTax
+        start = time.time()
+        for state in states:
+            calculateTax(1000, state)
+        taxSeconds = time.time() - start
+
+        calculateShipping = ShippingCalculator.calculateShipping
+        start = time.time()
+        for zipCode in zipCodes:
+            calculateShipping(zipCode)
+        shippingSeconds = time.time() - start
+    finally:
+        PricingRules.install(active)
+    return taxSeconds / lookups * 1e9, shippingSeconds / lookups * 1e9
+
+
+if __name__ == '__main__':
+
+    lookups = 200000
+    if len(sys.argv) > 1:
+        lookups = int(sys.argv[1])
+    print "%8s %12s %12s" % ('rules', 'tax ns', 'shipping ns')
+    for numRules in (4, 50, 500, 5000, 50000):
+        taxNs, shippingNs = timeLookups(numRules, lookups)
+        print "%8d %12.0f %12.0f" % (numRules, taxNs, shippingNs)